@@ -0,0 +1,195 @@
+"""Benchmarks the HLS generator routes in-process against a local TAMS stand-in.
+
+Each route is invoked through the Lambda handler with a Function URL event, so routing,
+rendering and response encoding are all included. AWS lookups (the TAMS token, codec
+mappings and the Function URL) are replaced with fixed values. Peak memory is measured
+with tracemalloc over a separate invocation and includes the stand-in serving that request.
+
+Run from backend/components/hls with the function and layer dependencies installed:
+
+    pip install aws-lambda-powertools boto3 -r functions/hls-generator/requirements.txt
+    python -m benchmark.run --shape av --segments 150 5000 50000 --latency-ms 20
+"""
+
+import argparse
+import contextlib
+import io
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+from benchmark.tams_stand_in import SHAPES, TamsStandIn
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(COMPONENT_DIR, "functions", "hls-generator")
+LAYER_DIR = os.path.join(COMPONENT_DIR, "..", "..", "layers", "openid-auth")
+CODEC_MAPPINGS = {"video/h264": "avc1", "audio/aac": "mp4a", "text/vtt": "webvtt"}
+
+
+class StaticCredentials:
+    def token(self):
+        return "benchmark"
+
+
+class Context:
+    function_name = "hls-generator-benchmark"
+    memory_limit_in_mb = 1024
+    invoked_function_arn = (
+        "arn:aws:lambda:eu-west-1:123456789012:function:hls-generator-benchmark"
+    )
+    aws_request_id = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--shape", choices=SHAPES, default="av")
+    parser.add_argument("--segments", type=int, nargs="+", default=[150, 5000, 50000])
+    parser.add_argument("--segment-duration", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--routes",
+        nargs="+",
+        choices=["source", "flow", "segments", "source-mpd", "flow-mpd"],
+        default=["source", "flow", "segments"],
+    )
+    parser.add_argument(
+        "--live", action="store_true", help="mark flows as ingesting (live playlists)"
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="keep the container caches enabled"
+    )
+    return parser.parse_args()
+
+
+def load_app(endpoint, warm):
+    """Imports the function with its environment pointed at the stand-in"""
+    os.environ.update(
+        {
+            "TAMS_ENDPOINT": endpoint,
+            # Placeholder, as get_creds is replaced and no secret is ever read
+            "SECRET_ARN": "benchmark",  # nosec B105
+            "DEFAULT_HLS_SEGMENTS": "150",
+            "CODEC_PARAMETER": "benchmark",
+            "POWERTOOLS_TRACE_DISABLED": "1",
+            "POWERTOOLS_LOG_LEVEL": "ERROR",
+            "POWERTOOLS_SERVICE_NAME": "hls-generator-benchmark",
+            "POWERTOOLS_METRICS_NAMESPACE": "Benchmark",
+        }
+    )
+    for name, value in {
+        "AWS_REGION": "eu-west-1",
+        "AWS_DEFAULT_REGION": "eu-west-1",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        # Placeholder so boto3 can presign URLs against the stand-in, not a real key
+        "AWS_SECRET_ACCESS_KEY": "benchmark",  # nosec B105
+    }.items():
+        os.environ.setdefault(name, value)
+    if not warm:
+        for name in ("FLOW_CACHE_TTL", "SOURCE_FLOWS_CACHE_TTL", "SEGMENT_WINDOW_TTL"):
+            os.environ[name] = "0"
+    sys.path[:0] = [FUNCTION_DIR, LAYER_DIR]
+    import app  # pylint: disable=import-outside-toplevel
+
+    app.get_creds = StaticCredentials
+    app.get_codec_mappings = lambda: CODEC_MAPPINGS
+    app.get_function_url = lambda: "https://benchmark.lambda-url.eu-west-1.on.aws/"
+    return app
+
+
+def url_event(path):
+    return {
+        "version": "2.0",
+        "rawPath": path,
+        "rawQueryString": "",
+        "headers": {"accept-encoding": "gzip"},
+        "isBase64Encoded": False,
+        "requestContext": {
+            "http": {"method": "GET", "path": path},
+            "requestId": "benchmark",
+            "stage": "$default",
+            "domainName": "benchmark.lambda-url.eu-west-1.on.aws",
+        },
+    }
+
+
+def invoke(app, path):
+    # Metrics are written to stdout as EMF, which would swamp the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = app.lambda_handler(url_event(path), Context())
+    if response["statusCode"] != 200:
+        raise RuntimeError(f"{path} returned {response['statusCode']}")
+    return response
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def benchmark(app, stand_in, path, iterations):
+    invoke(app, path)  # Warm up imports and connection pools
+    requests_before = stand_in.requests
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = invoke(app, path)
+        latencies.append(time.perf_counter() - start)
+    tams_requests = (stand_in.requests - requests_before) / iterations
+    tracemalloc.start()
+    invoke(app, path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "peak": peak / 2**20,
+        "bytes": len(response["body"]),
+        "tams_requests": tams_requests,
+    }
+
+
+def main():
+    args = parse_args()
+    stand_in = TamsStandIn(page_size=args.page_size, latency=args.latency_ms / 1000)
+    app = load_app(stand_in.start(), args.warm)
+    try:
+        print(
+            f"shape={args.shape} page_size={args.page_size} latency={args.latency_ms}ms"
+            f" iterations={args.iterations} live={args.live} warm={args.warm}"
+        )
+        print(
+            f"{'route':<12}{'segments':>10}{'p50 ms':>12}{'p99 ms':>12}"
+            f"{'peak MiB':>12}{'body bytes':>14}{'TAMS reqs':>12}"
+        )
+        for segment_count in args.segments:
+            source_id, flows = stand_in.add_source(
+                args.shape, segment_count, args.segment_duration, args.live
+            )
+            leaf_flow = next(flow for flow in flows if flow.get("container"))
+            paths = {
+                "source": f"/sources/{source_id}/manifest.m3u8",
+                "flow": f"/flows/{flows[0]['id']}/manifest.m3u8",
+                "segments": f"/flows/{leaf_flow['id']}/segments/manifest.m3u8",
+                "source-mpd": f"/sources/{source_id}/manifest.mpd",
+                "flow-mpd": f"/flows/{flows[0]['id']}/manifest.mpd",
+            }
+            for route in args.routes:
+                result = benchmark(app, stand_in, paths[route], args.iterations)
+                print(
+                    f"{route:<12}{segment_count:>10}{result['p50']:>12.1f}"
+                    f"{result['p99']:>12.1f}{result['peak']:>12.1f}"
+                    f"{result['bytes']:>14}{result['tams_requests']:>12.1f}"
+                )
+    finally:
+        stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""In-memory stand-in for the parts of the TAMS API read by the HLS generator.
+
+Serves /flows, /flows/{id} and /flows/{id}/segments over HTTP on localhost, with paging,
+reverse_order and timerange filtering, and an optional latency added to every request."""
+
+import json
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from mediatimestamp.immutable import TimeRange
+
+SHAPES = ("single", "av", "ladder")
+
+
+def make_flow(source_id, flow_format, segment_count, **properties):
+    flow = {
+        "id": str(uuid.uuid4()),
+        "source_id": source_id,
+        "format": flow_format,
+        "description": flow_format.split(":")[-1],
+        "created": "2024-01-01T00:00:00Z",
+        "tags": {"hls_segments": str(segment_count)},
+    }
+    flow.update(properties)
+    return flow
+
+
+def make_source(shape, segment_count, segment_duration=2, live=False):
+    """Builds the flows of one source with the given hierarchy shape.
+
+    single: one video flow
+    av: a multi flow collecting one video and one audio flow
+    ladder: a multi flow collecting three video renditions, two audio languages and a subtitle flow
+    """
+    source_id = str(uuid.uuid4())
+    media = {
+        "container": "video/mp2t",
+        "segment_duration": {"numerator": segment_duration, "denominator": 1},
+    }
+    video_count, audio_languages, subtitles = {
+        "single": (1, [], False),
+        "av": (1, ["en"], False),
+        "ladder": (3, ["en", "fr"], True),
+    }[shape]
+    flows = []
+    for rendition in range(video_count):
+        flows.append(
+            make_flow(
+                source_id,
+                "urn:x-nmos:format:video",
+                segment_count,
+                codec="video/h264",
+                max_bit_rate=6000000 // (rendition + 1),
+                essence_parameters={
+                    "frame_width": 1920 // (rendition + 1),
+                    "frame_height": 1080 // (rendition + 1),
+                    "frame_rate": {"numerator": 25, "denominator": 1},
+                    "avc_parameters": {"profile": 100, "flags": 0, "level": 40},
+                },
+                **media,
+            )
+        )
+    for language in audio_languages:
+        flows.append(
+            make_flow(
+                source_id,
+                "urn:x-nmos:format:audio",
+                segment_count,
+                codec="audio/aac",
+                essence_parameters={
+                    "channels": 2,
+                    "sample_rate": {"numerator": 48000},
+                    "codec_parameters": {"mp4_oti": 2},
+                },
+                **media,
+            )
+        )
+        flows[-1]["tags"]["hls_language"] = language
+    if subtitles:
+        flows.append(
+            make_flow(
+                source_id,
+                "urn:x-nmos:format:data",
+                segment_count,
+                codec="text/vtt",
+                essence_parameters={"data_type": "urn:x-tams:data:subtitle"},
+                **{**media, "container": "text/vtt"},
+            )
+        )
+    if live:
+        for flow in flows:
+            flow["tags"]["flow_status"] = "ingesting"
+    if len(flows) > 1:
+        flows.insert(
+            0,
+            make_flow(
+                source_id,
+                "urn:x-nmos:format:multi",
+                segment_count,
+                flow_collection=[
+                    {"id": flow["id"], "role": flow["format"].split(":")[-1]}
+                    for flow in flows
+                ],
+            ),
+        )
+    return source_id, flows
+
+
+def make_segments(flow_id, segment_count, segment_duration=2, start=1700000000):
+    """Contiguous segments with presigned-style URLs of a realistic length"""
+    signature = "X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Credential=AKIAEXAMPLE%2F20240101%2Feu-west-1%2Fs3%2Faws4_request&X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600&X-Amz-SignedHeaders=host&X-Amz-Signature="
+    segments = []
+    for index in range(segment_count):
+        object_id = str(uuid.uuid4())
+        segment_start = start + index * segment_duration
+        segments.append(
+            {
+                "object_id": object_id,
+                "timerange": f"[{segment_start}:0_{segment_start + segment_duration}:0)",
+                "get_urls": [
+                    {
+                        "url": f"https://tams-media.s3.eu-west-1.amazonaws.com/{object_id}?{signature}{'0' * 64}",
+                        "presigned": True,
+                    }
+                ],
+            }
+        )
+    return segments
+
+
+class TamsStandIn:
+    def __init__(self, page_size=300, latency=0.0):
+        self.page_size = page_size
+        self.latency = latency
+        self.flows = {}
+        self.segments = {}
+        self._segment_starts = {}
+        self.requests = 0
+        self._server = None
+
+    def add_source(self, shape, segment_count, segment_duration=2, live=False):
+        source_id, flows = make_source(shape, segment_count, segment_duration, live)
+        for flow in flows:
+            self.flows[flow["id"]] = flow
+            if flow.get("container"):
+                self.segments[flow["id"]] = make_segments(
+                    flow["id"], segment_count, segment_duration
+                )
+                self._segment_starts[flow["id"]] = [
+                    TimeRange.from_str(segment["timerange"]).start
+                    for segment in self.segments[flow["id"]]
+                ]
+        return source_id, flows
+
+    def append_segments(self, flow_id, segment_count, segment_duration=2):
+        """Adds segments after the last one of a flow, as TAMS does while a flow is ingested"""
+        last_end = TimeRange.from_str(self.segments[flow_id][-1]["timerange"]).end
+        segments = make_segments(
+            flow_id, segment_count, segment_duration, start=int(last_end.to_float())
+        )
+        self.segments[flow_id].extend(segments)
+        self._segment_starts[flow_id].extend(
+            TimeRange.from_str(segment["timerange"]).start for segment in segments
+        )
+        return segments
+
+    def get_segments_page(self, flow_id, query):
+        segments = self.segments.get(flow_id, [])
+        first, last = 0, len(segments)
+        if "timerange" in query:
+            timerange = TimeRange.from_str(query["timerange"])
+            starts = self._segment_starts[flow_id]
+            if timerange.start is not None:
+                # Contiguous segments, so the one before the first start may still overlap
+                first = max(bisect_right(starts, timerange.start) - 1, 0)
+                if first < len(segments) and not TimeRange.from_str(
+                    segments[first]["timerange"]
+                ).overlaps_with_timerange(timerange):
+                    first += 1
+            if timerange.end is not None:
+                last = bisect_left(starts, timerange.end)
+        limit = min(int(query.get("limit", self.page_size)), self.page_size)
+        offset = int(query.get("page", 0))
+        reverse = query.get("reverse_order") == "true"
+        count = last - first
+        page_indexes = range(offset, min(offset + limit, count))
+        if reverse:
+            page = [segments[last - 1 - index] for index in page_indexes]
+        else:
+            page = [segments[first + index] for index in page_indexes]
+        next_offset = offset + limit if offset + limit < count else None
+        return page, next_offset
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, body, links=None, status=200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if links:
+                    self.send_header("Link", links)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                stand_in.requests += 1
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                parts = url.path.strip("/").split("/")
+                if parts == ["flows"]:
+                    return self.send_json(
+                        [
+                            flow
+                            for flow in stand_in.flows.values()
+                            if flow["source_id"] == query.get("source_id")
+                        ]
+                    )
+                if parts[0] != "flows" or parts[1] not in stand_in.flows:
+                    return self.send_json({"message": "not found"}, status=404)
+                if len(parts) == 2:
+                    return self.send_json(stand_in.flows[parts[1]])
+                page, next_offset = stand_in.get_segments_page(parts[1], query)
+                links = None
+                if next_offset is not None:
+                    next_query = urlencode(dict(query, page=next_offset))
+                    links = f'<{stand_in.endpoint}{url.path}?{next_query}>; rel="next"'
+                return self.send_json(page, links)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.endpoint
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,50 @@
+"""Fixtures for the HLS generator tests, which run the function in-process against the benchmark's
+TAMS stand-in. Run from backend/components/hls with the benchmark dependencies installed:
+
+    python -m pytest tests
+"""
+
+import base64
+import contextlib
+import gzip
+import io
+from urllib.parse import urlencode
+
+import pytest
+from benchmark.run import Context, load_app, url_event
+from benchmark.tams_stand_in import TamsStandIn
+
+
+@pytest.fixture(scope="session")
+def tams():
+    stand_in = TamsStandIn()
+    endpoint = stand_in.start()
+    yield stand_in, endpoint
+    stand_in.stop()
+
+
+@pytest.fixture(scope="session")
+def hls_app(tams):
+    """The function, imported once with its container caches disabled"""
+    return load_app(tams[1], warm=False)
+
+
+@pytest.fixture(scope="session")
+def invoke_route(hls_app):
+    """Invokes the function with a Function URL request, returning the response and its decoded body"""
+
+    def invoke(path, query=None, headers=None):
+        event = url_event(path)
+        if query:
+            event["rawQueryString"] = urlencode(query)
+            event["queryStringParameters"] = query
+        event["headers"].update(headers or {})
+        # Metrics are written to stdout as EMF
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = hls_app.lambda_handler(event, Context())
+        body = response.get("body") or ""
+        if response.get("isBase64Encoded"):
+            body = gzip.decompress(base64.b64decode(body)).decode()
+        return response, body
+
+    return invoke
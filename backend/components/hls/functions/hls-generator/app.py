@@ -1,32 +1,120 @@
+import concurrent.futures
+import hashlib
+import hmac
+import io
 import json
 import os
-from collections import defaultdict, deque
-from datetime import datetime
-from functools import lru_cache
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from html import escape
 from http import HTTPStatus
-from urllib.parse import quote, urlparse
+from urllib.parse import quote, unquote, urlencode, urlparse
 
 import boto3
 import m3u8
 import requests
-from aws_lambda_powertools import Logger, Tracer
+from aws_lambda_powertools import Logger, Metrics, Tracer
 from aws_lambda_powertools.event_handler import LambdaFunctionUrlResolver, Response
+from aws_lambda_powertools.metrics import EphemeralMetrics, MetricUnit
+from aws_lambda_powertools.utilities.data_classes.event_bridge_event import (
+    EventBridgeEvent,
+)
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from botocore.auth import SigV4QueryAuth
 from botocore.awsrequest import AWSRequest
-from mediatimestamp.immutable import TimeRange
+from botocore.exceptions import ClientError
+from cache import TTLCache
+from m3u8.model import number_to_string
+from mediatimestamp.immutable import TimeRange, Timestamp
 from openid_auth import Credentials
+from stages import StageTimer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 tracer = Tracer()
 logger = Logger()
+metrics = Metrics()
+# Per-request stage timings, published with a route dimension separately from the shared metrics
+stage_timer = StageTimer()
 app = LambdaFunctionUrlResolver()
 
 ssm = boto3.client("ssm")
+s3 = boto3.client("s3")
 
 endpoint = os.environ["TAMS_ENDPOINT"]
 secret_arn = os.environ["SECRET_ARN"]
 default_hls_segments = os.environ["DEFAULT_HLS_SEGMENTS"]
 codec_parameter = os.environ["CODEC_PARAMETER"]
+flow_fetch_workers = int(os.environ.get("FLOW_FETCH_WORKERS", "8"))
+segments_page_limit = int(os.environ.get("SEGMENTS_PAGE_LIMIT", "300"))
+
+# Flow documents are cached in the warm container; a TTL of 0 disables caching for that kind
+flow_cache = TTLCache(
+    max_size=int(os.environ.get("FLOW_CACHE_SIZE", "256")),
+    ttls={
+        "Flow": float(os.environ.get("FLOW_CACHE_TTL", "5")),
+        "SourceFlows": float(os.environ.get("SOURCE_FLOWS_CACHE_TTL", "5")),
+    },
+)
+# Rolling segment windows of ingesting flows; the TTL forces a periodic full refresh so
+# deleted segments and expiring presigned URLs are not served from the window indefinitely
+segment_window_cache = TTLCache(
+    max_size=int(os.environ.get("SEGMENT_WINDOW_CACHE_SIZE", "32")),
+    ttls={"SegmentWindow": float(os.environ.get("SEGMENT_WINDOW_TTL", "60"))},
+)
+# Segment windows of ingesting child flows can be fetched in the background when a master
+# manifest is served; 0 workers disables this. Threads only run while the container is
+# handling a request, so a window is normally finished by the following child request.
+prewarm_workers = int(os.environ.get("PREWARM_WORKERS", "0"))
+prewarm_max_age = float(os.environ.get("PREWARM_MAX_AGE", "2"))
+prewarm_executor = (
+    concurrent.futures.ThreadPoolExecutor(max_workers=prewarm_workers)
+    if prewarm_workers > 0
+    else None
+)
+prewarm_futures = {}
+prewarm_lock = threading.Lock()
+prewarm_stats = Counter()
+blocking_reload_timeout = float(os.environ.get("BLOCKING_RELOAD_TIMEOUT", "20"))
+blocking_reload_poll_interval = float(
+    os.environ.get("BLOCKING_RELOAD_POLL_INTERVAL", "0.5")
+)
+# The HLS spec requires the skip boundary to be at least six target durations
+skip_until_target_durations = max(
+    6.0, float(os.environ.get("SKIP_UNTIL_TARGET_DURATIONS", "6"))
+)
+# Set when pre-rendered manifests are published to S3 in response to TAMS events
+manifest_bucket = os.environ.get("MANIFEST_BUCKET")
+manifest_cache_max_age = int(os.environ.get("MANIFEST_CACHE_MAX_AGE", "300"))
+presigned_url_expiry = int(os.environ.get("PRESIGNED_URL_EXPIRY", "3600"))
+# Where segment URLs come from: "tams" has TAMS presign every URL, "signed" requests unsigned
+# URLs and presigns them here, and "cdn" rewrites the object path onto SEGMENT_CDN_ORIGIN
+segment_urls = os.environ.get("SEGMENT_URLS", "tams").lower()
+segment_cdn_origin = os.environ.get("SEGMENT_CDN_ORIGIN", "").rstrip("/")
+# How DASH representations address segments: "template" writes a SegmentTemplate resolved by the
+# segment redirect route, so MPD size follows the timeline runs, and "list" writes every segment URL
+dash_segment_addressing = os.environ.get("DASH_SEGMENT_ADDRESSING", "template").lower()
+# Object URLs on the global S3 endpoint do not name a region, so they are signed for the media bucket's
+media_bucket_region = os.environ.get("MEDIA_BUCKET_REGION") or os.environ["AWS_REGION"]
+
+SIGNED_URL_EXPIRY = 600
+# Signed child playlist URLs are reused until less than this fraction of their lifetime is left
+signed_url_reuse_fraction = min(
+    max(float(os.environ.get("SIGNED_URL_REUSE_FRACTION", "0.5")), 0.0), 1.0
+)
+signed_url_cache = TTLCache(
+    max_size=int(os.environ.get("SIGNED_URL_CACHE_SIZE", "512")),
+    ttls={"SignedUrl": SIGNED_URL_EXPIRY * (1 - signed_url_reuse_fraction)},
+)
+MANIFEST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+MPD_CONTENT_TYPE = "application/dash+xml"
+DASH_TIMESCALE = 90000  # MPEG-TS clock, so common segment durations are whole ticks
 
 
 @lru_cache()
@@ -54,9 +142,146 @@ def get_function_url():
         return None
 
 
+@lru_cache()
+def get_lambda_credentials():
+    """Credentials of the Lambda execution role, resolved once per container"""
+    return boto3.Session().get_credentials()
+
+
+@lru_cache(maxsize=8)
+def get_signing_key(secret_key, date, region, service):
+    """SigV4 signing key, which only changes per credential and day"""
+    key = f"AWS4{secret_key}".encode()
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+class CachedKeySigV4QueryAuth(SigV4QueryAuth):
+    """SigV4 query string signer that reuses the derived signing key"""
+
+    def signature(self, string_to_sign, request):
+        signing_key = get_signing_key(
+            self.credentials.secret_key,
+            request.context["timestamp"][0:8],
+            self._region_name,
+            self._service_name,
+        )
+        return self._sign(signing_key, string_to_sign, hex=True)
+
+
+class ObjectUrlSigner:
+    """Presigns S3 object URLs for one signing time, reusing everything except the per-object hash and signature"""
+
+    def __init__(self, credentials, region, signing_time, expires_in):
+        self._amz_date = signing_time.strftime("%Y%m%dT%H%M%SZ")
+        self._scope = f"{self._amz_date[0:8]}/{region}/s3/aws4_request"
+        self._signing_key = get_signing_key(
+            credentials.secret_key, self._amz_date[0:8], region, "s3"
+        )
+        params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{credentials.access_key}/{self._scope}",
+            "X-Amz-Date": self._amz_date,
+            "X-Amz-Expires": str(expires_in),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if credentials.token:
+            params["X-Amz-Security-Token"] = credentials.token
+        self._query = "&".join(
+            f"{quote(key, safe='~')}={quote(value, safe='~')}"
+            for key, value in sorted(params.items())
+        )
+
+    def sign(self, host, path):
+        canonical_path = quote(unquote(path), safe="/~")
+        canonical_request = f"GET\n{canonical_path}\n{self._query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+        string_to_sign = f"AWS4-HMAC-SHA256\n{self._amz_date}\n{self._scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+        signature = hmac.new(
+            self._signing_key, string_to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+        return (
+            f"https://{host}{canonical_path}?{self._query}&X-Amz-Signature={signature}"
+        )
+
+
+@lru_cache(maxsize=8)
+def get_object_url_signer(region, signing_epoch):
+    return ObjectUrlSigner(
+        get_lambda_credentials().get_frozen_credentials(),
+        region,
+        datetime.fromtimestamp(signing_epoch, timezone.utc),
+        presigned_url_expiry,
+    )
+
+
+def get_bucket_region(host):
+    """Region of a virtual-hosted or path-style S3 endpoint, defaulting to the function's region"""
+    labels = host.split(".")
+    if "amazonaws" not in labels:
+        return os.environ["AWS_REGION"]
+    # The region, if any, is the label nearest the domain, e.g. s3.eu-west-1, s3.dualstack.eu-west-1 or s3-eu-west-1
+    for label in reversed(labels[: len(labels) - labels[::-1].index("amazonaws") - 1]):
+        if label == "dualstack":
+            continue
+        if label in ("s3", "s3-accelerate"):
+            break
+        return label.removeprefix("s3-")
+    # Global and accelerate endpoints do not name a region, so the media bucket's is used
+    return media_bucket_region
+
+
+def sign_object_url(object_url):
+    """Presigns an unsigned TAMS object URL with the execution role's credentials"""
+    parsed = urlparse(object_url)
+    # The signing time is held for a window so consecutive renders produce identical manifests
+    window = max(int(min(manifest_cache_max_age, presigned_url_expiry / 2)), 1)
+    signing_epoch = int(time.time()) // window * window
+    return get_object_url_signer(get_bucket_region(parsed.netloc), signing_epoch).sign(
+        parsed.netloc, parsed.path
+    )
+
+
+@lru_cache(maxsize=1)
+def warn_presigned_fallback():
+    """Logs once per container, rather than once per segment, that presigned URLs are being served"""
+    logger.warning(
+        f"TAMS returned segments without unsigned URLs; serving presigned URLs instead of '{segment_urls}' URLs"
+    )
+
+
+def get_segment_url(segment):
+    """URL a player fetches a segment from, according to the SEGMENT_URLS mode"""
+    if segment_urls == "tams":
+        presigned_urls = [
+            get_url["url"]
+            for get_url in segment["get_urls"]
+            if get_url.get("presigned", False)
+        ]
+        return presigned_urls[0]
+    object_urls = [
+        get_url["url"]
+        for get_url in segment["get_urls"]
+        if not get_url.get("presigned", False)
+    ]
+    if not object_urls:
+        # The store only offered presigned URLs, which can be neither rewritten nor signed again
+        warn_presigned_fallback()
+        return segment["get_urls"][0]["url"]
+    if segment_urls == "cdn":
+        return f"{segment_cdn_origin}{urlparse(object_urls[0]).path}"
+    return sign_object_url(object_urls[0])
+
+
 @tracer.capture_method(capture_response=False)
-def get_signed_url(obj, expires_in=600):
+@stage_timer.stage("Signing")
+def get_signed_url(obj, expires_in=SIGNED_URL_EXPIRY, params=None):
     """Generate presigned URL for Lambda Function URL path"""
+    query = f"?{urlencode(params)}" if params else ""
+    # Reusing a URL while it is still fresh keeps consecutive manifests byte-identical
+    signed_url = signed_url_cache.get("SignedUrl", f"{expires_in}:{obj}{query}")
+    if signed_url is not None:
+        return signed_url
     function_url = get_function_url()
     if not function_url:
         raise RuntimeError(
@@ -66,11 +291,10 @@ def get_signed_url(obj, expires_in=600):
     region = os.environ["AWS_REGION"]
     # Encode path segments but keep slashes
     encoded_obj = "/".join(quote(segment, safe="") for segment in obj.split("/"))
-    full_url = f"{function_url.rstrip('/')}/{encoded_obj}"
+    full_url = f"{function_url.rstrip('/')}/{encoded_obj}{query}"
 
     # Get credentials from Lambda execution role
-    session = boto3.Session()
-    credentials = session.get_credentials().get_frozen_credentials()
+    credentials = get_lambda_credentials().get_frozen_credentials()
 
     # Create request for signing
     request = AWSRequest(method="GET", url=full_url)
@@ -78,11 +302,29 @@ def get_signed_url(obj, expires_in=600):
     request.headers["Host"] = parsed.netloc
 
     # Sign with query string auth (adds signature as URL params)
-    SigV4QueryAuth(credentials, "lambda", region, expires=expires_in).add_auth(request)
+    CachedKeySigV4QueryAuth(credentials, "lambda", region, expires=expires_in).add_auth(
+        request
+    )
 
+    if expires_in == SIGNED_URL_EXPIRY:
+        signed_url_cache.put("SignedUrl", f"{expires_in}:{obj}{query}", request.url)
     return request.url
 
 
+def get_master_max_age():
+    """Master manifests carry signed child URIs, so cached copies must expire while those are still valid"""
+    return min(
+        manifest_cache_max_age, SIGNED_URL_EXPIRY * signed_url_reuse_fraction / 2
+    )
+
+
+def get_signed_playlist_url(flow_id, timerange=None):
+    return get_signed_url(
+        f"flows/{flow_id}/segments/manifest.m3u8",
+        params={"timerange": timerange} if timerange else None,
+    )
+
+
 @lru_cache()
 def get_codec_mappings():
     get_parameter = ssm.get_parameter(Name=codec_parameter)["Parameter"]
@@ -162,67 +404,299 @@ def get_hls_props(flow, flow_pos):
 
 @tracer.capture_method(capture_response=False)
 def get_flow(flow_id):
-    get = requests.get(
-        f"{endpoint}/flows/{flow_id}",
-        headers={
-            "Authorization": f"Bearer {get_creds().token()}",
-        },
-        timeout=30,
-    )
-    get.raise_for_status()
-    return get.json()
+    flow = flow_cache.get("Flow", flow_id)
+    if flow is not None:
+        return flow
+    with stage_timer.stage("FlowFetch"):
+        get = requests.get(
+            f"{endpoint}/flows/{flow_id}",
+            headers={
+                "Authorization": f"Bearer {get_creds().token()}",
+            },
+            timeout=30,
+        )
+        get.raise_for_status()
+        flow = get.json()
+    flow_cache.put("Flow", flow_id, flow)
+    return flow
 
 
 @tracer.capture_method(capture_response=False)
 def get_flows(source_id):
-    get = requests.get(
-        f"{endpoint}/flows?source_id={source_id}",
-        headers={
-            "Authorization": f"Bearer {get_creds().token()}",
-        },
-        timeout=30,
-    )
+    flows = flow_cache.get("SourceFlows", source_id)
+    if flows is not None:
+        return flows
+    with stage_timer.stage("FlowFetch"):
+        get = requests.get(
+            f"{endpoint}/flows?source_id={source_id}",
+            headers={
+                "Authorization": f"Bearer {get_creds().token()}",
+            },
+            timeout=30,
+        )
+        get.raise_for_status()
+        flows = get.json()
+    flow_cache.put("SourceFlows", source_id, flows)
+    for flow in flows:
+        flow_cache.put("Flow", flow["id"], flow)
+    return flows
+
+
+def get_segments_page(url, headers):
+    get = requests.get(url, headers=headers, timeout=30)
     get.raise_for_status()
-    return get.json()
+    return get.json(), get.links.get("next", {}).get("url")
 
 
 @tracer.capture_method(capture_response=False)
-def get_segments(flow_id, segment_count):
-    limit_query = (
-        f"&limit={int(segment_count)}" if segment_count != float("inf") else ""
+def get_segments(flow_id, segment_count, timerange=None, reverse_order=True):
+    """Yields segments page by page, fetching the next page while the current one is consumed"""
+    page_limit = (
+        min(int(segment_count), segments_page_limit)
+        if segment_count != float("inf")
+        else segments_page_limit
     )
-    get = requests.get(
-        f"{endpoint}/flows/{flow_id}/segments?reverse_order=true{limit_query}",
-        headers={
-            "Authorization": f"Bearer {get_creds().token()}",
-        },
-        timeout=30,
+    timerange_query = f"&timerange={timerange}" if timerange else ""
+    # Presigning every URL is costly for TAMS, so it is skipped when URLs are signed or rewritten here
+    presigned_query = "&presigned=false" if segment_urls != "tams" else ""
+    headers = {"Authorization": f"Bearer {get_creds().token()}"}
+    url = f"{endpoint}/flows/{flow_id}/segments?reverse_order={str(reverse_order).lower()}&limit={page_limit}{timerange_query}{presigned_query}"
+    pages_fetched = 0
+    page_wait = 0.0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        pending = executor.submit(get_segments_page, url, headers)
+        count = 0
+        while pending is not None:
+            wait_start = time.perf_counter()
+            page, next_url = pending.result()
+            wait = time.perf_counter() - wait_start
+            stage_timer.add("SegmentPaging", wait)
+            stage_timer.count("PagesFetched")
+            page_wait += wait
+            pages_fetched += 1
+            # Only prefetch when this page cannot satisfy the requested count
+            pending = (
+                executor.submit(get_segments_page, next_url, headers)
+                if next_url and count + len(page) < segment_count
+                else None
+            )
+            for segment in page:
+                count += 1
+                yield segment
+                if count >= segment_count:
+                    return
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        tracer.put_annotation(key="SegmentPagesFetched", value=pages_fetched)
+        tracer.put_annotation(key="SegmentPageWaitMs", value=round(page_wait * 1000))
+
+
+@tracer.capture_method(capture_response=False)
+def get_timed_segments(flow_id, segment_count, timerange=None):
+    """Returns the newest segments in playing order, paired with their parsed timerange"""
+    timed_segments = []
+    parsing = 0.0
+    for segment in get_segments(flow_id, segment_count, timerange):
+        parse_start = time.perf_counter()
+        timed_segments.append((segment, TimeRange.from_str(segment["timerange"])))
+        parsing += time.perf_counter() - parse_start
+    stage_timer.add("TimerangeParsing", parsing)
+    timed_segments.reverse()  # Segments are fetched newest first
+    return timed_segments
+
+
+@tracer.capture_method(capture_response=False)
+def get_live_segment_window(flow_id, segment_count):
+    """Returns the newest segments of an ingesting flow, using a window prewarmed for this request where there is one"""
+    with prewarm_lock:
+        prewarm = prewarm_futures.pop(flow_id, None)
+    if prewarm is not None:
+        future, queued = prewarm
+        # An unfinished prewarm is joined rather than refreshing the same window concurrently
+        if not future.done() or time.monotonic() - queued <= prewarm_max_age:
+            try:
+                window = future.result()
+                with prewarm_lock:
+                    prewarm_stats["PrewarmHits"] += 1
+                return window
+            # pylint: disable=broad-exception-caught
+            except Exception:
+                logger.warning(f"Prewarm of flow {flow_id} failed; fetching again")
+    return refresh_segment_window(flow_id, segment_count)
+
+
+@tracer.capture_method(capture_response=False)
+def refresh_segment_window(flow_id, segment_count):
+    """Returns the newest segments of an ingesting flow, only fetching those added since the cached window was last refreshed"""
+    window_size = None if segment_count == float("inf") else int(segment_count)
+    window = segment_window_cache.get("SegmentWindow", flow_id)
+    if not window or window.maxlen != window_size:
+        window = deque(get_timed_segments(flow_id, segment_count), maxlen=window_size)
+        segment_window_cache.put("SegmentWindow", flow_id, window)
+        return list(window)
+    last_end = window[-1][1].end
+    # A full page of new segments means the whole window is replaced, as with a full fetch
+    window.extend(
+        (segment, segment_timerange)
+        for segment, segment_timerange in get_timed_segments(
+            flow_id, segment_count, str(TimeRange.from_start(last_end))
+        )
+        if segment_timerange.start >= last_end
     )
-    get.raise_for_status()
-    count = 0
-    for segment in get.json():
-        count += 1
-        yield segment
-        if count >= segment_count:
+    return list(window)
+
+
+def iter_vod_segments(flow_id, segment_count, timerange=None):
+    """Yields the newest segments of a finished flow, or every segment of a timerange, in playing order"""
+    if timerange:
+        # The playlist is marked as ended, so the whole range is returned rather than the window size
+        segment_count = float("inf")
+    if segment_count == float("inf"):
+        # Segments are wanted from the start, so they can be read oldest first and never held in memory
+        yield from get_segments(flow_id, segment_count, timerange, reverse_order=False)
+    else:
+        yield from reversed(list(get_segments(flow_id, segment_count)))
+
+
+@tracer.capture_method(capture_response=False)
+@stage_timer.stage("Render")
+def render_vod_segments_playlist(segments, segment_duration):
+    """Writes a VOD media playlist straight from a segment iterator, bypassing the m3u8 object model.
+
+    The output is identical to building the playlist with m3u8.M3U8. Memory is bounded by one
+    page of segments from TAMS plus the playlist text, which is held at most three times while
+    the response body is assembled (roughly the presigned URL length plus 20 bytes per segment).
+    """
+    body = io.StringIO()
+    max_duration = 0
+    prev_ts_offset = None
+    segment_count = 0
+    parsing = 0.0
+    for segment in segments:
+        parse_start = time.perf_counter()
+        duration = TimeRange.from_str(segment["timerange"]).length.to_unix_float()
+        parsing += time.perf_counter() - parse_start
+        segment_count += 1
+        max_duration = max(max_duration, duration)
+        ts_offset = segment.get("ts_offset", "")
+        if prev_ts_offset is not None:
+            body.write("\n")
+            if prev_ts_offset != ts_offset:
+                body.write("#EXT-X-DISCONTINUITY\n")
+        body.write(f"#EXTINF:{number_to_string(duration)},\n{get_segment_url(segment)}")
+        prev_ts_offset = ts_offset
+    stage_timer.add("TimerangeParsing", parsing)
+    stage_timer.count("SegmentsRendered", segment_count)
+    if segment_duration > 0:
+        target_duration = segment_duration
+    else:
+        # Derive from actual segment durations (HLS spec requires this tag)
+        max_duration = max_duration or 10
+        target_duration = int(max_duration) + (1 if max_duration % 1 else 0)
+    lines = ["#EXTM3U"]
+    if prev_ts_offset is not None:
+        lines.append("#EXT-X-MEDIA-SEQUENCE:1")
+    lines.extend(
+        [
+            "#EXT-X-VERSION:4",
+            f"#EXT-X-TARGETDURATION:{number_to_string(target_duration)}",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            body.getvalue(),
+            "#EXT-X-ENDLIST",
+            "",
+        ]
+    )
+    return "\n".join(lines)
+
+
+def get_media_sequence(first_segment_timerange, flow_created_epoch, segment_duration):
+    """Media sequence number of a live segment, derived from its offset to the flow creation time"""
+    return int(
+        (first_segment_timerange.start.to_float() - flow_created_epoch)
+        / segment_duration
+    )
+
+
+@tracer.capture_method(capture_response=False)
+@stage_timer.stage("BlockingReload")
+def wait_for_media_sequence(
+    flow_id, segment_count, hls_msn, flow_created_epoch, segment_duration
+):
+    """Long-polls the live segment window until it contains the requested media sequence number.
+
+    Returns None if the segment has not arrived within the blocking reload timeout."""
+    remaining_seconds = app.lambda_context.get_remaining_time_in_millis() / 1000 - 2
+    deadline = time.monotonic() + min(
+        blocking_reload_timeout, 3 * segment_duration, remaining_seconds
+    )
+    while True:
+        segments = get_live_segment_window(flow_id, segment_count)
+        if segments and (
+            get_media_sequence(segments[0][1], flow_created_epoch, segment_duration)
+            + len(segments)
+            - 1
+            >= hls_msn
+        ):
+            return segments
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(blocking_reload_poll_interval, remaining))
+
+
+def get_skipped_segment_count(segments, skip_until):
+    """Number of leading segments that end before the skip boundary of a delta playlist"""
+    skip_before = segments[-1][1].end.to_float() - skip_until
+    skipped = 0
+    for _, segment_timerange in segments:
+        if segment_timerange.end.to_float() > skip_before:
             break
-    while "next" in get.links and count < segment_count:
-        get = requests.get(
-            get.links["next"]["url"],
-            headers={
-                "Authorization": f"Bearer {get_creds().token()}",
-            },
-            timeout=30,
+        skipped += 1
+    return skipped
+
+
+def is_hls_excluded(flow):
+    return flow.get("tags", {}).get("hls_exclude", "false").lower() == "true"
+
+
+@tracer.capture_method(capture_response=False)
+@stage_timer.stage("FlowFetch")
+def get_flows_by_id(flow_ids):
+    """Fetch the supplied flows concurrently using a bounded worker pool"""
+    if not flow_ids:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(flow_fetch_workers, len(flow_ids))
+    ) as executor:
+        return dict(zip(flow_ids, executor.map(get_flow, flow_ids)))
+
+
+@tracer.capture_method(capture_response=False)
+def resolve_flow_hierarchy(flows):
+    """Fetch every flow reachable through flow_collection, one hierarchy level at a time"""
+    flows_by_id = {flow["id"]: flow for flow in flows}
+    level = list(flows)
+    while level:
+        # Members of excluded flows are never walked, so there is no need to fetch them
+        pending_ids = list(
+            dict.fromkeys(
+                collected["id"]
+                for flow in level
+                if not is_hls_excluded(flow)
+                for collected in flow.get("flow_collection", [])
+                if collected["id"] not in flows_by_id
+            )
         )
-        get.raise_for_status()
-        for segment in get.json():
-            count += 1
-            yield segment
-            if count >= segment_count:
-                break
+        fetched = get_flows_by_id(pending_ids)
+        flows_by_id.update(fetched)
+        level = list(fetched.values())
+    return flows_by_id
 
 
 @tracer.capture_method(capture_response=False)
 def get_collected_flows(flows):
+    resolved_flows = resolve_flow_hierarchy(flows)
     flows_queue = deque(flows)
     flows_dict = defaultdict(list)
     flows_by_id = {}
@@ -234,7 +708,7 @@ def get_collected_flows(flows):
         visited.add(flow["id"])
         flows_by_id[flow["id"]] = flow
         # Check if flow is marked as exclude
-        if flow.get("tags", {}).get("hls_exclude", "false").lower() == "true":
+        if is_hls_excluded(flow):
             continue
         # A flow is a leaf (segment-owning) if it has a container. Classify it.
         # Flows without a container are pure collection wrappers (e.g. the top-level multi).
@@ -255,13 +729,19 @@ def get_collected_flows(flows):
         if flow.get("flow_collection"):
             for collected in flow["flow_collection"]:
                 if collected["id"] not in visited:
-                    flows_queue.append(get_flow(collected["id"]))
+                    flows_queue.append(resolved_flows[collected["id"]])
+    stage_timer.count("FlowsResolved", len(flows_by_id))
     return flows_dict, flows_by_id
 
 
 @tracer.capture_method(capture_response=False)
 def get_collection_hls(
-    video_flows, audio_flows, subtitle_flows, muxed_flows, flows_by_id
+    video_flows,
+    audio_flows,
+    subtitle_flows,
+    muxed_flows,
+    flows_by_id,
+    playlist_uri=get_signed_playlist_url,
 ):
     # Sort by max_bit_rate descending (highest quality first)
     # TAMS spec: max_bit_rate is optional, default to 0 for flows without bit rate info
@@ -278,7 +758,7 @@ def get_collection_hls(
                 **get_hls_props(flow, i),
                 type="SUBTITLES",
                 group_id="subs",
-                uri=get_signed_url(f"flows/{flow['id']}/segments/manifest.m3u8"),
+                uri=playlist_uri(flow["id"]),
             )
             if i == 0:
                 first_subtitle = media
@@ -295,7 +775,7 @@ def get_collection_hls(
             manifest.add_playlist(
                 m3u8.Playlist(
                     stream_info=stream_info,
-                    uri=get_signed_url(f"flows/{flow['id']}/segments/manifest.m3u8"),
+                    uri=playlist_uri(flow["id"]),
                     media=m3u8.MediaList(
                         [media for media in [first_subtitle] if media]
                     ),
@@ -310,7 +790,7 @@ def get_collection_hls(
             **get_hls_props(flow, i),
             type="SUBTITLES",
             group_id="subs",
-            uri=get_signed_url(f"flows/{flow['id']}/segments/manifest.m3u8"),
+            uri=playlist_uri(flow["id"]),
         )
         if i == 0:
             first_subtitle = media
@@ -324,7 +804,7 @@ def get_collection_hls(
                 type="AUDIO",
                 group_id="audio",
                 channels=flow["essence_parameters"]["channels"],
-                uri=get_signed_url(f"flows/{flow['id']}/segments/manifest.m3u8"),
+                uri=playlist_uri(flow["id"]),
                 codecs=map_codec(flow),
             )
             if i == 0:
@@ -354,7 +834,7 @@ def get_collection_hls(
         manifest.add_playlist(
             m3u8.Playlist(
                 stream_info=stream_info,
-                uri=get_signed_url(f"flows/{flow['id']}/segments/manifest.m3u8"),
+                uri=playlist_uri(flow["id"]),
                 media=m3u8.MediaList(
                     [media for media in [first_audio, first_subtitle] if media]
                 ),
@@ -399,7 +879,7 @@ def get_collection_hls(
         manifest.add_playlist(
             m3u8.Playlist(
                 stream_info=stream_info,
-                uri=get_signed_url(f"flows/{flow['id']}/segments/manifest.m3u8"),
+                uri=playlist_uri(flow["id"]),
                 media=m3u8.MediaList([media for media in [first_subtitle] if media]),
                 base_uri=None,
             )
@@ -407,24 +887,462 @@ def get_collection_hls(
     return manifest.dumps()
 
 
-@app.get("/sources/<sourceId>/manifest.m3u8")
+def get_flow_playlist_settings(flow):
+    """Returns the created time, segment duration, window size and live state used to render a flow's media playlist"""
+    flow_created_epoch = datetime.strptime(
+        flow["created"], "%Y-%m-%dT%H:%M:%SZ"
+    ).timestamp()
+    flow_segment_duration = flow.get(
+        "segment_duration", {"numerator": 0, "denominator": 1}
+    )
+    flow_segment_duration_float = flow_segment_duration[
+        "numerator"
+    ] / flow_segment_duration.get("denominator", 1)
+    hls_segment_count = float(
+        flow.get("tags", {}).get("hls_segments", default_hls_segments)
+    )
+    flow_ingesting = flow.get("tags", {}).get("flow_status", "") == "ingesting"
+    return (
+        flow_created_epoch,
+        flow_segment_duration_float,
+        hls_segment_count,
+        flow_ingesting,
+    )
+
+
 @tracer.capture_method(capture_response=False)
-def get_source_hls(sourceId: str):
+@stage_timer.stage("Render")
+def build_live_segments_manifest(
+    segments,
+    flow_created_epoch,
+    flow_segment_duration,
+    hls_skip=False,
+    server_control=True,
+):
+    """Builds the media playlist of an ingesting flow from its segment window.
+
+    server_control advertises blocking reloads and delta updates, which static copies cannot serve."""
+    manifest = m3u8.M3U8()
+    manifest.version = 4
+    # Blocking reloads rely on media sequence numbers derived from segment_duration
+    can_block_reload = flow_segment_duration > 0
+    if (
+        flow_segment_duration > 0
+    ):  # Zero value would be where Flow does not have segment_duration specified
+        manifest.target_duration = flow_segment_duration
+    else:
+        # Derive from actual segment durations (HLS spec requires this tag)
+        max_duration = max(
+            (
+                segment_timerange.length.to_unix_float()
+                for _, segment_timerange in segments
+            ),
+            default=10,
+        )
+        manifest.target_duration = int(max_duration) + (1 if max_duration % 1 else 0)
+    skipped_segments = 0
+    if can_block_reload and server_control:
+        skip_until = skip_until_target_durations * manifest.target_duration
+        manifest.server_control = m3u8.ServerControl(
+            can_block_reload="YES", can_skip_until=skip_until
+        )
+        if hls_skip and segments:
+            skipped_segments = get_skipped_segment_count(segments, skip_until)
+        if skipped_segments:
+            manifest.version = 9  # EXT-X-SKIP requires protocol version 9
+            manifest.skip = m3u8.Skip(skipped_segments=skipped_segments)
+    if segments:
+        first_segment_timestamp = segments[0][1]
+        if can_block_reload:
+            manifest.media_sequence = get_media_sequence(
+                first_segment_timestamp,
+                flow_created_epoch,
+                flow_segment_duration,
+            )
+        else:
+            manifest.media_sequence = 1
+        manifest.program_date_time = f"{datetime.fromtimestamp(first_segment_timestamp.start.to_float()).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}+00:00"
+    prev_ts_offset = None
+    for index, (segment, segment_timerange) in enumerate(segments):
+        ts_offset = segment.get("ts_offset", "")
+        if index < skipped_segments:
+            prev_ts_offset = ts_offset
+            continue
+        segment_duration = segment_timerange.length.to_unix_float()
+        is_discontinuity = prev_ts_offset is not None and prev_ts_offset != ts_offset
+        manifest.add_segment(
+            segment=m3u8.Segment(
+                duration=segment_duration,
+                uri=get_segment_url(segment),
+                discontinuity=is_discontinuity,
+            )
+        )
+        prev_ts_offset = ts_offset
+    stage_timer.count("SegmentsRendered", len(segments) - skipped_segments)
+    return manifest
+
+
+def prewarm_segment_window(flow):
+    start = time.monotonic()
     try:
-        flows = get_flows(sourceId)
-        flows_dict, flows_by_id = get_collected_flows(flows)
+        return refresh_segment_window(flow["id"], get_flow_playlist_settings(flow)[2])
+    finally:
+        with prewarm_lock:
+            prewarm_stats["PrewarmedWindows"] += 1
+            prewarm_stats["PrewarmTime"] += (time.monotonic() - start) * 1000
+
+
+def queue_segment_window_prewarm(flows):
+    """Starts fetching the segment windows of ingesting flows before their playlists are requested"""
+    if prewarm_executor is None:
+        return
+    for flow in flows:
+        if not get_flow_playlist_settings(flow)[3]:
+            continue  # Only live windows are cached
+        with prewarm_lock:
+            pending = prewarm_futures.get(flow["id"])
+            if pending is None or pending[0].done():
+                prewarm_futures[flow["id"]] = (
+                    prewarm_executor.submit(prewarm_segment_window, flow),
+                    time.monotonic(),
+                )
+
+
+@tracer.capture_method(capture_response=False)
+def render_collection_hls(flows, playlist_uri=get_signed_playlist_url, prewarm=False):
+    """Renders the master manifest for the supplied flows and their collections"""
+    flows_dict, flows_by_id = get_collected_flows(flows)
+    with stage_timer.stage("Render"):
         m3u8_content = get_collection_hls(
             flows_dict["video"],
             flows_dict["audio"],
             flows_dict["subtitle"],
             flows_dict["muxed"],
             flows_by_id,
+            playlist_uri,
         )
-        return Response(
-            status_code=HTTPStatus.OK.value,
-            content_type="application/vnd.apple.mpegurl",
-            body=m3u8_content,
+    if prewarm:
+        queue_segment_window_prewarm(
+            flow for leaf_flows in flows_dict.values() for flow in leaf_flows
+        )
+    return m3u8_content
+
+
+@tracer.capture_method(capture_response=False)
+def render_segments_playlist(flow, server_control=True, timerange=None):
+    """Renders the complete media playlist of a flow, returning it with the time it can be cached for.
+
+    A timerange addresses a fixed window of the flow, so it is always rendered as VOD."""
+    flow_created_epoch, flow_segment_duration, hls_segment_count, flow_ingesting = (
+        get_flow_playlist_settings(flow)
+    )
+    if timerange or not flow_ingesting:
+        return (
+            render_vod_segments_playlist(
+                iter_vod_segments(flow["id"], hls_segment_count, timerange),
+                flow_segment_duration,
+            ),
+            min(manifest_cache_max_age, presigned_url_expiry / 2),
+        )
+    manifest = build_live_segments_manifest(
+        get_live_segment_window(flow["id"], hls_segment_count),
+        flow_created_epoch,
+        flow_segment_duration,
+        server_control=server_control,
+    )
+    with stage_timer.stage("Render"):
+        body = manifest.dumps()
+    # Live playlists change every segment, so only reloads within a target duration share a copy
+    return body, manifest.target_duration / 2
+
+
+def get_segment_timeline(timed_segments):
+    """Collapses segments into SegmentTimeline runs of (start, duration, repeats) in DASH_TIMESCALE ticks.
+
+    A run only restarts when the duration changes or there is a gap, so a uniform flow is one run."""
+    runs = []
+    prev_end = None
+    for _, segment_timerange in timed_segments:
+        start = segment_timerange.start.to_count(DASH_TIMESCALE)
+        duration = segment_timerange.end.to_count(DASH_TIMESCALE) - start
+        if runs and start == prev_end and duration == runs[-1][1]:
+            runs[-1][2] += 1
+        else:
+            runs.append([start, duration, 0])
+        prev_end = start + duration
+    return runs
+
+
+def get_dash_segments(flow, timerange=None):
+    """The same segment window as the flow's media playlist, in playing order with parsed timeranges"""
+    _, _, hls_segment_count, flow_ingesting = get_flow_playlist_settings(flow)
+    if timerange or not flow_ingesting:
+        return [
+            (segment, TimeRange.from_str(segment["timerange"]))
+            for segment in iter_vod_segments(flow["id"], hls_segment_count, timerange)
+        ]
+    return get_live_segment_window(flow["id"], hls_segment_count)
+
+
+def summarise_dash_segments(flow, timerange=None):
+    """Reduces a flow's DASH segments to their timeline runs, SegmentURL text, extent and longest duration.
+
+    The segment records are dropped once summarised, so an MPD holds little more than its own text.
+    The SegmentURL text is only written when segments are addressed as a list."""
+    timed_segments = get_dash_segments(flow, timerange)
+    segment_url_text = ""
+    if dash_segment_addressing == "list":
+        segment_url_text = "".join(
+            f'          <SegmentURL media="{escape(get_segment_url(segment))}" />\n'
+            for segment, _ in timed_segments
         )
+    return (
+        get_segment_timeline(timed_segments),
+        segment_url_text,
+        min((tr.start for _, tr in timed_segments), default=None),
+        max((tr.end for _, tr in timed_segments), default=None),
+        max((tr.length.to_unix_float() for _, tr in timed_segments), default=None),
+    )
+
+
+def format_xml_attributes(attributes):
+    """Attribute text of an MPD element in insertion order, leaving out unset attributes"""
+    return "".join(
+        f' {name}="{escape(str(value))}"'
+        for name, value in attributes.items()
+        if value is not None
+    )
+
+
+def append_dash_representation(
+    body, attributes, runs, segment_url_text, presentation_time_offset
+):
+    body.append(f"      <Representation{format_xml_attributes(attributes)}>\n")
+    segment_element = "SegmentList"
+    segment_attributes = {
+        "timescale": DASH_TIMESCALE,
+        "presentationTimeOffset": presentation_time_offset,
+    }
+    if dash_segment_addressing != "list":
+        # Root-relative, so the redirect route is resolved against wherever the MPD was fetched
+        segment_element = "SegmentTemplate"
+        segment_attributes["media"] = f"/flows/{attributes['id']}/segment/$Time$"
+    body.append(
+        f"        <{segment_element}{format_xml_attributes(segment_attributes)}>\n"
+    )
+    if runs:
+        body.append("          <SegmentTimeline>\n")
+        for start, duration, repeats in runs:
+            repeat = f' r="{repeats}"' if repeats else ""
+            body.append(f'            <S t="{start}" d="{duration}"{repeat} />\n')
+        body.append("          </SegmentTimeline>\n")
+    else:
+        body.append("          <SegmentTimeline />\n")
+    body.append(segment_url_text)
+    body.append(f"        </{segment_element}>\n      </Representation>\n")
+
+
+def get_video_attributes(essence_parameters):
+    frame_rate = essence_parameters["frame_rate"]
+    return {
+        "width": essence_parameters["frame_width"],
+        "height": essence_parameters["frame_height"],
+        "frameRate": f"{frame_rate['numerator']}/{frame_rate.get('denominator', 1)}",
+    }
+
+
+@tracer.capture_method(capture_response=False)
+@stage_timer.stage("Render")
+def render_collection_mpd(flows, timerange=None):
+    """Renders a DASH MPD for the supplied flows and their collections, classified as for HLS.
+
+    The MPD is written as text from per-flow segment summaries rather than built as an element
+    tree, so the text (roughly the presigned URL length plus 40 bytes per segment) is held at
+    most twice while the response body is joined."""
+    flows_dict, flows_by_id = get_collected_flows(flows)
+    flows_dict["video"].sort(key=lambda k: k.get("max_bit_rate", 0), reverse=True)
+    flows_dict["muxed"].sort(key=lambda k: k.get("max_bit_rate", 0), reverse=True)
+    rendered_flows = [
+        flow
+        for content_type in ("video", "muxed", "audio", "subtitle")
+        for flow in flows_dict[content_type]
+    ]
+    summaries_by_id = {}
+    if rendered_flows:
+        with (
+            stage_timer.stage("SegmentPaging"),
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(flow_fetch_workers, len(rendered_flows))
+            ) as executor,
+        ):
+            summaries_by_id = dict(
+                zip(
+                    [flow["id"] for flow in rendered_flows],
+                    executor.map(
+                        partial(summarise_dash_segments, timerange=timerange),
+                        rendered_flows,
+                    ),
+                )
+            )
+    summaries = list(summaries_by_id.values())
+    stage_timer.count(
+        "SegmentsRendered",
+        sum(repeats + 1 for runs, *_ in summaries for _, _, repeats in runs),
+    )
+    first_start = min(
+        (first for _, _, first, _, _ in summaries if first is not None), default=None
+    )
+    last_end = max(
+        (last for _, _, _, last, _ in summaries if last is not None), default=None
+    )
+    live_segment_durations = [
+        segment_duration
+        for _, segment_duration, _, flow_ingesting in map(
+            get_flow_playlist_settings, rendered_flows
+        )
+        if flow_ingesting and not timerange
+    ]
+    mpd_attributes = {
+        "xmlns": "urn:mpeg:dash:schema:mpd:2011",
+        "profiles": "urn:mpeg:dash:profile:full:2011",
+        "minBufferTime": "PT2S",
+    }
+    if live_segment_durations:
+        # Timeline ticks are counted from the epoch, matching the program date time used for HLS
+        max_duration = max(
+            (longest for *_, longest in summaries if longest is not None),
+            default=10,
+        )
+        update_period = max(live_segment_durations + [max_duration])
+        mpd_attributes["type"] = "dynamic"
+        mpd_attributes["availabilityStartTime"] = "1970-01-01T00:00:00Z"
+        mpd_attributes["publishTime"] = datetime.now(timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+        mpd_attributes["minimumUpdatePeriod"] = f"PT{number_to_string(update_period)}S"
+        if first_start is not None:
+            mpd_attributes["timeShiftBufferDepth"] = (
+                f"PT{number_to_string((last_end - first_start).to_unix_float())}S"
+            )
+        presentation_time_offset = 0
+    else:
+        mpd_attributes["type"] = "static"
+        if first_start is not None:
+            mpd_attributes["mediaPresentationDuration"] = (
+                f"PT{number_to_string((last_end - first_start).to_unix_float())}S"
+            )
+        presentation_time_offset = (
+            first_start.to_count(DASH_TIMESCALE) if first_start is not None else 0
+        )
+    body = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n',
+        f"<MPD{format_xml_attributes(mpd_attributes)}>\n",
+    ]
+    period = '  <Period id="0" start="PT0S"'
+    for content_type, flows_of_type in (
+        ("video", flows_dict["video"]),
+        (None, flows_dict["muxed"]),
+        ("audio", flows_dict["audio"]),
+        ("text", flows_dict["subtitle"]),
+    ):
+        # One adaptation set per container, as a player switches between its representations
+        by_container = defaultdict(list)
+        for flow in flows_of_type:
+            by_container[flow["container"]].append(flow)
+        for container, container_flows in by_container.items():
+            if period:
+                body.append(f"{period}>\n")
+                period = None
+            language = container_flows[0].get("tags", {}).get("hls_language")
+            adaptation_set_attributes = {
+                "mimeType": container,
+                "segmentAlignment": "true",
+                "contentType": content_type,
+                "lang": language if content_type in ("audio", "text") else None,
+            }
+            body.append(
+                f"    <AdaptationSet{format_xml_attributes(adaptation_set_attributes)}>\n"
+            )
+            for flow in container_flows:
+                # Muxed flows take their codecs and picture size from their collected members
+                members = [flow]
+                if content_type is None:
+                    collected = [
+                        flows_by_id[c["id"]] for c in flow.get("flow_collection", [])
+                    ]
+                    members = [
+                        member
+                        for member in (
+                            next((f for f in collected if f["format"] == essence), None)
+                            for essence in (
+                                "urn:x-nmos:format:video",
+                                "urn:x-nmos:format:audio",
+                            )
+                        )
+                        if member
+                    ]
+                representation_attributes = {
+                    "id": flow["id"],
+                    "bandwidth": flow.get("max_bit_rate", 0),
+                    "codecs": ",".join(map_codec(member) for member in members),
+                    "mimeType": flow["container"],
+                }
+                video_member = next(
+                    (m for m in members if m["format"] == "urn:x-nmos:format:video"),
+                    None,
+                )
+                if video_member:
+                    representation_attributes.update(
+                        get_video_attributes(video_member["essence_parameters"])
+                    )
+                elif content_type == "audio":
+                    sample_rate = flow.get("essence_parameters", {}).get("sample_rate")
+                    if sample_rate:
+                        representation_attributes["audioSamplingRate"] = sample_rate[
+                            "numerator"
+                        ] // sample_rate.get("denominator", 1)
+                runs, segment_url_text, *_ = summaries_by_id[flow["id"]]
+                append_dash_representation(
+                    body,
+                    representation_attributes,
+                    runs,
+                    segment_url_text,
+                    presentation_time_offset,
+                )
+            body.append("    </AdaptationSet>\n")
+    body.append(f"{period} />\n" if period else "  </Period>\n")
+    body.append("</MPD>")
+    if live_segment_durations:
+        return "".join(body), update_period / 2
+    if dash_segment_addressing == "list":
+        return "".join(body), min(manifest_cache_max_age, presigned_url_expiry / 2)
+    return "".join(body), manifest_cache_max_age
+
+
+def get_timerange_query():
+    """Normalised timerange query parameter, raising ValueError if it is not a valid TAMS timerange"""
+    timerange = app.current_event.get_query_string_value("timerange")
+    if timerange is None:
+        return None
+    with stage_timer.stage("TimerangeParsing"):
+        return str(TimeRange.from_str(timerange))
+
+
+@app.get("/sources/<sourceId>/manifest.m3u8")
+@tracer.capture_method(capture_response=False)
+def get_source_hls(sourceId: str):
+    try:
+        try:
+            timerange = get_timerange_query()
+        except ValueError:
+            return Response(status_code=HTTPStatus.BAD_REQUEST.value)
+        # Children of a timerange master are VOD playlists, which are not cached
+        m3u8_content = render_collection_hls(
+            get_flows(sourceId),
+            partial(get_signed_playlist_url, timerange=timerange),
+            prewarm=not timerange,
+        )
+        return get_manifest_response(m3u8_content, get_master_max_age())
     except requests.HTTPError as ex:
         if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
             return Response(status_code=HTTPStatus.NOT_FOUND.value)
@@ -440,20 +1358,16 @@ def get_source_hls(sourceId: str):
 @tracer.capture_method(capture_response=False)
 def get_flow_hls(flowId: str):
     try:
-        flow = get_flow(flowId)
-        flows_dict, flows_by_id = get_collected_flows([flow])
-        m3u8_content = get_collection_hls(
-            flows_dict["video"],
-            flows_dict["audio"],
-            flows_dict["subtitle"],
-            flows_dict["muxed"],
-            flows_by_id,
-        )
-        return Response(
-            status_code=HTTPStatus.OK.value,
-            content_type="application/vnd.apple.mpegurl",
-            body=m3u8_content,
+        try:
+            timerange = get_timerange_query()
+        except ValueError:
+            return Response(status_code=HTTPStatus.BAD_REQUEST.value)
+        m3u8_content = render_collection_hls(
+            [get_flow(flowId)],
+            partial(get_signed_playlist_url, timerange=timerange),
+            prewarm=not timerange,
         )
+        return get_manifest_response(m3u8_content, get_master_max_age())
     except requests.HTTPError as ex:
         if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
             return Response(status_code=HTTPStatus.NOT_FOUND.value)
@@ -465,86 +1379,159 @@ def get_flow_hls(flowId: str):
         return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
 
 
+@app.get("/sources/<sourceId>/manifest.mpd")
+@tracer.capture_method(capture_response=False)
+def get_source_dash(sourceId: str):
+    try:
+        try:
+            timerange = get_timerange_query()
+        except ValueError:
+            return Response(status_code=HTTPStatus.BAD_REQUEST.value)
+        return get_manifest_response(
+            *render_collection_mpd(get_flows(sourceId), timerange),
+            content_type=MPD_CONTENT_TYPE,
+        )
+    except requests.HTTPError as ex:
+        if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
+            return Response(status_code=HTTPStatus.NOT_FOUND.value)
+        logger.exception("Error generating source MPD")
+        return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+    # pylint: disable=broad-exception-caught
+    except Exception:
+        logger.exception("Error generating source MPD")
+        return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+
+
+@app.get("/flows/<flowId>/manifest.mpd")
+@tracer.capture_method(capture_response=False)
+def get_flow_dash(flowId: str):
+    try:
+        try:
+            timerange = get_timerange_query()
+        except ValueError:
+            return Response(status_code=HTTPStatus.BAD_REQUEST.value)
+        return get_manifest_response(
+            *render_collection_mpd([get_flow(flowId)], timerange),
+            content_type=MPD_CONTENT_TYPE,
+        )
+    except requests.HTTPError as ex:
+        if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
+            return Response(status_code=HTTPStatus.NOT_FOUND.value)
+        logger.exception("Error generating flow MPD")
+        return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+    # pylint: disable=broad-exception-caught
+    except Exception:
+        logger.exception("Error generating flow MPD")
+        return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+
+
+@app.get("/flows/<flowId>/segment/<segmentStart>")
+@tracer.capture_method(capture_response=False)
+def get_segment_redirect(flowId: str, segmentStart: str):
+    """Redirects a DASH SegmentTemplate request, addressed by its start in DASH_TIMESCALE ticks, to the segment"""
+    try:
+        if not segmentStart.isdigit():
+            return Response(status_code=HTTPStatus.NOT_FOUND.value)
+        start = int(segmentStart)
+        # Timeline starts are rounded to ticks, so the segment starting within a tick is matched
+        search_timerange = TimeRange(
+            Timestamp.from_count(start - 1, DASH_TIMESCALE),
+            Timestamp.from_count(start + 1, DASH_TIMESCALE),
+        )
+        segment = next(
+            (
+                segment
+                for segment in get_segments(
+                    flowId, 3, str(search_timerange), reverse_order=False
+                )
+                if TimeRange.from_str(segment["timerange"]).start.to_count(
+                    DASH_TIMESCALE
+                )
+                == start
+            ),
+            None,
+        )
+        if segment is None:
+            return Response(status_code=HTTPStatus.NOT_FOUND.value)
+        return Response(
+            status_code=HTTPStatus.FOUND.value,
+            headers={
+                "Location": get_segment_url(segment),
+                "Cache-Control": f"max-age={int(min(manifest_cache_max_age, presigned_url_expiry / 2))}",
+            },
+        )
+    except requests.HTTPError as ex:
+        if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
+            return Response(status_code=HTTPStatus.NOT_FOUND.value)
+        logger.exception("Error redirecting to segment")
+        return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+    # pylint: disable=broad-exception-caught
+    except Exception:
+        logger.exception("Error redirecting to segment")
+        return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+
+
 @app.get("/flows/<flowId>/segments/manifest.m3u8")
 @tracer.capture_method(capture_response=False)
 def get_segments_hls(flowId: str):
     try:
-        manifest = m3u8.M3U8()
-        manifest.version = 4
+        hls_msn = app.current_event.get_query_string_value("_HLS_msn")
+        hls_part = app.current_event.get_query_string_value("_HLS_part")
+        # v2 also allows skipping date ranges, none of which are emitted
+        hls_skip = app.current_event.get_query_string_value("_HLS_skip") in (
+            "YES",
+            "v2",
+        )
+        if hls_part is not None and hls_msn is None:
+            return Response(status_code=HTTPStatus.BAD_REQUEST.value)
+        try:
+            timerange = get_timerange_query()
+            hls_msn = int(hls_msn) if hls_msn is not None else None
+            # Partial segments are not produced, so a part request only waits for its segment
+            hls_part = int(hls_part) if hls_part is not None else None
+        except ValueError:
+            return Response(status_code=HTTPStatus.BAD_REQUEST.value)
         flow = get_flow(flowId)
-        flow_created_epoch = datetime.strptime(
-            flow["created"], "%Y-%m-%dT%H:%M:%SZ"
-        ).timestamp()
-        flow_segment_duration = flow.get(
-            "segment_duration", {"numerator": 0, "denominator": 1}
-        )
-        flow_segment_duration_float = flow_segment_duration[
-            "numerator"
-        ] / flow_segment_duration.get("denominator", 1)
-        hls_segment_count = float(
-            flow.get("tags", {}).get("hls_segments", default_hls_segments)
-        )
-        flow_ingesting = flow.get("tags", {}).get("flow_status", "") == "ingesting"
-        segments = list(get_segments(flowId, hls_segment_count))[
-            ::-1
-        ]  # Need to reverse segments for correct playing order
-        if (
-            flow_segment_duration_float > 0
-        ):  # Zero value would be where Flow does not have segment_duration specified
-            manifest.target_duration = flow_segment_duration_float
-        else:
-            # Derive from actual segment durations (HLS spec requires this tag)
-            max_duration = max(
-                (
-                    TimeRange.from_str(s["timerange"]).length.to_unix_float()
-                    for s in segments
-                ),
-                default=10,
+        stage_timer.count("FlowsResolved")
+        (
+            flow_created_epoch,
+            flow_segment_duration_float,
+            hls_segment_count,
+            flow_ingesting,
+        ) = get_flow_playlist_settings(flow)
+        if timerange or not flow_ingesting or (hls_msn is None and not hls_skip):
+            return get_manifest_response(
+                *render_segments_playlist(flow, timerange=timerange)
             )
-            manifest.target_duration = int(max_duration) + (
-                1 if max_duration % 1 else 0
-            )
-        if segments:
-            first_segment_timestamp = TimeRange.from_str(segments[0]["timerange"])
-            if flow_ingesting and flow_segment_duration_float > 0:
-                manifest.media_sequence = int(
-                    (first_segment_timestamp.start.to_float() - flow_created_epoch)
-                    / flow_segment_duration_float
+        segments = get_live_segment_window(flowId, hls_segment_count)
+        if flow_segment_duration_float > 0 and hls_msn is not None:
+            next_msn = (
+                get_media_sequence(
+                    segments[0][1], flow_created_epoch, flow_segment_duration_float
                 )
-            else:
-                manifest.media_sequence = 1
-            manifest.program_date_time = f"{datetime.fromtimestamp(first_segment_timestamp.start.to_float()).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}+00:00"
-        if not flow_ingesting:
-            manifest.playlist_type = "VOD"
-        prev_ts_offset = None
-        for segment in segments:
-            presigned_urls = [
-                get_url["url"]
-                for get_url in segment["get_urls"]
-                if get_url.get("presigned", False)
-            ]
-            segment_duration = TimeRange.from_str(
-                segment["timerange"]
-            ).length.to_unix_float()
-            ts_offset = segment.get("ts_offset", "")
-            is_discontinuity = (
-                prev_ts_offset is not None and prev_ts_offset != ts_offset
+                + len(segments)
+                if segments
+                else 0
             )
-            manifest.add_segment(
-                segment=m3u8.Segment(
-                    duration=segment_duration,
-                    uri=f"{presigned_urls[0]}",
-                    discontinuity=is_discontinuity,
+            # Blocking requests may look at most two segments past the last one (next_msn - 1)
+            if segments and hls_msn > next_msn + 1:
+                return Response(status_code=HTTPStatus.BAD_REQUEST.value)
+            if hls_msn >= next_msn:
+                segments = wait_for_media_sequence(
+                    flowId,
+                    hls_segment_count,
+                    hls_msn,
+                    flow_created_epoch,
+                    flow_segment_duration_float,
                 )
-            )
-            prev_ts_offset = ts_offset
-        if not flow_ingesting:
-            manifest.is_endlist = True
-        return Response(
-            status_code=HTTPStatus.OK.value,
-            content_type="application/vnd.apple.mpegurl",
-            body=manifest.dumps(),
+                if segments is None:
+                    return Response(status_code=HTTPStatus.SERVICE_UNAVAILABLE.value)
+        manifest = build_live_segments_manifest(
+            segments, flow_created_epoch, flow_segment_duration_float, hls_skip
         )
+        with stage_timer.stage("Render"):
+            body = manifest.dumps()
+        return get_manifest_response(body, manifest.target_duration / 2)
     except requests.HTTPError as ex:
         if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
             return Response(status_code=HTTPStatus.NOT_FOUND.value)
@@ -556,8 +1543,287 @@ def get_segments_hls(flowId: str):
         return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value)
 
 
+def get_accepted_encodings(accept_encoding):
+    """Content codings from an Accept-Encoding header, excluding any refused with q=0"""
+    encodings = set()
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        weight = params.replace(" ", "").removeprefix("q=")
+        try:
+            if params and float(weight) == 0:
+                continue
+        except ValueError:
+            pass
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    )
+
+
+@tracer.capture_method(capture_response=False)
+@stage_timer.stage("Response")
+def get_manifest_response(body, max_age, content_type=MANIFEST_CONTENT_TYPE):
+    """Builds a manifest response with a content-derived ETag, Cache-Control and optional compression"""
+    encoded_body = body.encode()
+    # Weak validator, as the same manifest may be served with different content encodings
+    etag = f'W/"{hashlib.sha256(encoded_body).hexdigest()[:32]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"max-age={max(int(max_age), 0)}",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = app.current_event.get_header_value("if-none-match", "")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED.value, headers=headers)
+    accepted_encodings = get_accepted_encodings(
+        app.current_event.get_header_value("accept-encoding", "")
+    )
+    if brotli and "br" in accepted_encodings:
+        headers["Content-Encoding"] = "br"
+        compressed_body = brotli.compress(encoded_body)
+        stage_timer.count("BytesEmitted", len(compressed_body))
+        return Response(
+            status_code=HTTPStatus.OK.value,
+            content_type=content_type,
+            body=compressed_body,
+            headers=headers,
+        )
+    # Gzip is applied by the resolver, so the uncompressed size is counted
+    stage_timer.count("BytesEmitted", len(encoded_body))
+    return Response(
+        status_code=HTTPStatus.OK.value,
+        content_type=content_type,
+        body=body,
+        headers=headers,
+        compress="gzip" in accepted_encodings,
+    )
+
+
+def get_relative_playlist_uri(flow_id):
+    """Media playlist URI relative to a published master manifest (sources/<id>/ or flows/<id>/)"""
+    return f"../../flows/{flow_id}/segments/manifest.m3u8"
+
+
+@tracer.capture_method(capture_response=False)
+def put_manifest(key, body, max_age, metadata=None):
+    s3.put_object(
+        Bucket=manifest_bucket,
+        Key=key,
+        Body=body.encode(),
+        ContentType=MANIFEST_CONTENT_TYPE,
+        CacheControl=f"max-age={max(int(max_age), 0)}",
+        Metadata=metadata or {},
+    )
+
+
+@tracer.capture_method(capture_response=False)
+def delete_manifests(flow_id):
+    s3.delete_objects(
+        Bucket=manifest_bucket,
+        Delete={
+            "Objects": [
+                {"Key": f"flows/{flow_id}/manifest.m3u8"},
+                {"Key": f"flows/{flow_id}/segments/manifest.m3u8"},
+            ]
+        },
+    )
+
+
+@tracer.capture_method(capture_response=False)
+def publish_flow_manifest(flow):
+    put_manifest(
+        f"flows/{flow['id']}/manifest.m3u8",
+        render_collection_hls([flow], get_relative_playlist_uri),
+        manifest_cache_max_age,
+        # Kept with the manifest so the masters listing the flow can be found once it is deleted
+        metadata={
+            "source-id": flow["source_id"],
+            "collected-by": ",".join(flow.get("collected_by", [])),
+        },
+    )
+
+
+@tracer.capture_method(capture_response=False)
+def publish_source_manifest(source_id):
+    """Publishes the master manifest of a source, or deletes it once the source has no flows"""
+    flow_cache.invalidate("SourceFlows", source_id)
+    source_flows = get_flows(source_id)
+    if source_flows:
+        put_manifest(
+            f"sources/{source_id}/manifest.m3u8",
+            render_collection_hls(source_flows, get_relative_playlist_uri),
+            manifest_cache_max_age,
+        )
+    else:
+        s3.delete_object(
+            Bucket=manifest_bucket, Key=f"sources/{source_id}/manifest.m3u8"
+        )
+
+
+@tracer.capture_method(capture_response=False)
+def publish_master_manifests(flow):
+    """Publishes the master manifests of a flow and of its source"""
+    publish_flow_manifest(flow)
+    publish_source_manifest(flow["source_id"])
+
+
+@tracer.capture_method(capture_response=False)
+def get_published_flow_relations(flow_id):
+    """Source id and collecting flow ids of a flow, from the cache or its published master manifest"""
+    flow = flow_cache.get("Flow", flow_id)
+    if flow is not None:
+        return flow["source_id"], flow.get("collected_by", [])
+    try:
+        metadata = s3.head_object(
+            Bucket=manifest_bucket, Key=f"flows/{flow_id}/manifest.m3u8"
+        )["Metadata"]
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] == "404":
+            return None, []
+        raise ex
+    collected_by = metadata.get("collected-by", "")
+    return metadata.get("source-id"), collected_by.split(",") if collected_by else []
+
+
+@tracer.capture_method(capture_response=False)
+def publish_manifests_without_flow(source_id, parent_ids):
+    """Re-renders the source and collecting flow master manifests that listed a deleted flow"""
+    source_ids = {source_id} if source_id else set()
+    for parent_id in parent_ids:
+        flow_cache.invalidate("Flow", parent_id)
+        try:
+            parent = get_flow(parent_id)
+        except requests.HTTPError as ex:
+            # A parent deleted as well has its manifests removed by its own event
+            if ex.response.status_code == HTTPStatus.NOT_FOUND.value:
+                continue
+            raise ex
+        publish_flow_manifest(parent)
+        source_ids.add(parent["source_id"])
+    for parent_source_id in source_ids:
+        publish_source_manifest(parent_source_id)
+
+
+@tracer.capture_method(capture_response=False)
+def publish_segments_playlist(flow):
+    if is_hls_excluded(flow) or not flow.get("container"):
+        return
+    put_manifest(
+        f"flows/{flow['id']}/segments/manifest.m3u8",
+        *render_segments_playlist(flow, server_control=False),
+    )
+
+
+def add_cache_metrics():
+    """Publishes the cache and prewarm counters accumulated since the last invocation"""
+    for cache in (flow_cache, segment_window_cache, signed_url_cache):
+        for (kind, event), count in cache.pop_stats().items():
+            metrics.add_metric(
+                name=f"{kind}Cache{event}", unit=MetricUnit.Count, value=count
+            )
+    # Prewarms can finish during a later invocation, so their cost is reported when it is known
+    with prewarm_lock:
+        stats = prewarm_stats.copy()
+        prewarm_stats.clear()
+    for name, value in stats.items():
+        metrics.add_metric(
+            name=name,
+            unit=MetricUnit.Milliseconds if name == "PrewarmTime" else MetricUnit.Count,
+            value=value,
+        )
+
+
+def get_route_name(path):
+    """Metric dimension for the route serving a request path, or None for unknown paths"""
+    parts = path.strip("/").split("/")
+    if (
+        len(parts) == 4
+        and parts[0] == "flows"
+        and parts[2:] == ["segments", "manifest.m3u8"]
+    ):
+        return "segments"
+    if len(parts) == 4 and parts[0] == "flows" and parts[2] == "segment":
+        return "segment"
+    if len(parts) == 3 and parts[0] in ("sources", "flows"):
+        route = parts[0].removesuffix("s")
+        if parts[2] == "manifest.m3u8":
+            return route
+        if parts[2] == "manifest.mpd":
+            return f"{route}-mpd"
+    return None
+
+
+def add_stage_metrics(path):
+    """Publishes the stage timings and cost counters of this request, dimensioned by route"""
+    timings, counts = stage_timer.pop()
+    route = get_route_name(path)
+    if route is None:
+        return
+    stage_metrics = EphemeralMetrics()
+    stage_metrics.add_dimension(name="route", value=route)
+    for stage, seconds in timings.items():
+        stage_metrics.add_metric(
+            name=f"{stage}Time", unit=MetricUnit.Milliseconds, value=seconds * 1000
+        )
+    for name, value in counts.items():
+        stage_metrics.add_metric(
+            name=name,
+            unit=MetricUnit.Bytes if name == "BytesEmitted" else MetricUnit.Count,
+            value=value,
+        )
+    stage_metrics.flush_metrics()
+
+
 @logger.inject_lambda_context(log_event=True)
 @tracer.capture_lambda_handler(capture_response=False)
+@metrics.log_metrics(capture_cold_start_metric=True)
 # pylint: disable=unused-argument
 def lambda_handler(event, context: LambdaContext) -> dict:
-    return app.resolve(event, context)
+    stage_timer.pop()  # Discard anything recorded outside a request, such as by prewarm threads
+    try:
+        # Time not attributed to a more specific stage, such as routing and serialisation
+        with stage_timer.stage("Other"):
+            return app.resolve(event, context)
+    finally:
+        add_cache_metrics()
+        add_stage_metrics(event.get("rawPath", ""))
+
+
+@logger.inject_lambda_context(log_event=True)
+@tracer.capture_lambda_handler(capture_response=False)
+@metrics.log_metrics(capture_cold_start_metric=True)
+# pylint: disable=unused-argument
+def render_handler(event: EventBridgeEvent, context: LambdaContext) -> None:
+    """Re-renders the manifests affected by a TAMS flow event and publishes them to S3"""
+    try:
+        detail = event["detail"]
+        detail_type = event["detail-type"]
+        flow_id = detail.get("flow_id") or detail["flow"]["id"]
+        if detail_type == "flows/deleted":
+            # Looked up before the flow's cache entry and manifests, which record them, are removed
+            source_id, parent_ids = get_published_flow_relations(flow_id)
+            flow_cache.invalidate("Flow", flow_id)
+            segment_window_cache.invalidate("SegmentWindow", flow_id)
+            delete_manifests(flow_id)
+            publish_manifests_without_flow(source_id, parent_ids)
+            return
+        if detail_type in ("flows/segments_added", "flows/segments_deleted"):
+            if detail_type == "flows/segments_deleted":
+                segment_window_cache.invalidate("SegmentWindow", flow_id)
+            publish_segments_playlist(get_flow(flow_id))
+            return
+        # Flow created or updated; the event carries the new flow document
+        flow = detail["flow"]
+        flow_cache.put("Flow", flow_id, flow)
+        segment_window_cache.invalidate("SegmentWindow", flow_id)
+        publish_master_manifests(flow)
+        publish_segments_playlist(flow)
+    finally:
+        add_cache_metrics()
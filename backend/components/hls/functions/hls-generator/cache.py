@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache for the warm container where each kind of entry has its own time to live"""
+
+    def __init__(self, max_size: int, ttls: dict[str, float]) -> None:
+        self._max_size = max_size
+        self._ttls = ttls
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def get(self, kind: str, key: str):
+        """Returns the cached value, or None if it is missing or has expired"""
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end((kind, key))
+                self.stats[(kind, "Hits")] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[(kind, key)]
+                self.stats[(kind, "Expirations")] += 1
+            self.stats[(kind, "Misses")] += 1
+            return None
+
+    def put(self, kind: str, key: str, value) -> None:
+        """Stores the value unless caching is disabled for this kind (a TTL of 0)"""
+        ttl = self._ttls.get(kind, 0)
+        if ttl <= 0 or self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[(kind, key)] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end((kind, key))
+            while len(self._entries) > self._max_size:
+                (evicted_kind, _), _ = self._entries.popitem(last=False)
+                self.stats[(evicted_kind, "Evictions")] += 1
+
+    def invalidate(self, kind: str, key: str) -> None:
+        with self._lock:
+            self._entries.pop((kind, key), None)
+
+    def pop_stats(self) -> Counter:
+        """Returns the counters accumulated since the last call and resets them"""
+        with self._lock:
+            stats, self.stats = self.stats, Counter()
+        return stats
@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """Accumulates the time spent in each stage of a request, along with counters that drive its cost.
+
+    Stages can be nested; time spent in an inner stage is only attributed to the inner stage. Only
+    time on the main thread is recorded, so work on worker threads is attributed to the stage the
+    request was waiting in and the stage timings add up to the request duration."""
+
+    def __init__(self) -> None:
+        self._stack = []  # Time spent in stages nested within each open stage
+        self._lock = threading.Lock()
+        self.timings = Counter()
+        self.counts = Counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            with self._lock:
+                self.timings[name] += elapsed - nested
+
+    def add(self, name: str, seconds: float) -> None:
+        """Records time measured by the caller, for stages too short to wrap individually"""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if self._stack:
+            self._stack[-1] += seconds
+        with self._lock:
+            self.timings[name] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += value
+
+    def pop(self) -> tuple[Counter, Counter]:
+        """Returns the timings (in seconds) and counters accumulated since the last call and resets them"""
+        with self._lock:
+            timings, self.timings = self.timings, Counter()
+            counts, self.counts = self.counts, Counter()
+        return timings, counts
@@ -0,0 +1,55 @@
+"""Blocking playlist reload limits of the segments playlist"""
+
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import pytest
+from benchmark.run import Context, url_event
+
+
+def get_status(app, flow_id, hls_msn):
+    event = url_event(f"/flows/{flow_id}/segments/manifest.m3u8")
+    event["rawQueryString"] = f"_HLS_msn={hls_msn}"
+    event["queryStringParameters"] = {"_HLS_msn": str(hls_msn)}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return app.lambda_handler(event, Context())["statusCode"]
+
+
+@pytest.fixture(scope="module")
+def live_flow(tams, hls_app):
+    _, flows = tams[0].add_source("single", 10, live=True)
+    flow = hls_app.get_flow(flows[0]["id"])
+    flow_created_epoch, segment_duration, segment_count, _ = (
+        hls_app.get_flow_playlist_settings(flow)
+    )
+    segments = hls_app.get_live_segment_window(flow["id"], segment_count)
+    last_msn = (
+        hls_app.get_media_sequence(segments[0][1], flow_created_epoch, segment_duration)
+        + len(segments)
+        - 1
+    )
+    return hls_app, flow["id"], last_msn
+
+
+class TestBlockingReload(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _live_flow(self, live_flow):
+        self.app, self.flow_id, self.last_msn = live_flow
+
+    def test_msn_more_than_two_past_last_segment_is_rejected(self):
+        with mock.patch.object(
+            self.app, "wait_for_media_sequence", return_value=None
+        ) as wait:
+            status = get_status(self.app, self.flow_id, self.last_msn + 3)
+        self.assertEqual(status, 400)
+        wait.assert_not_called()
+
+    def test_msn_two_past_last_segment_blocks(self):
+        with mock.patch.object(
+            self.app, "wait_for_media_sequence", return_value=None
+        ) as wait:
+            status = get_status(self.app, self.flow_id, self.last_msn + 2)
+        self.assertEqual(status, 503)
+        wait.assert_called_once()
@@ -0,0 +1,42 @@
+"""DASH MPD segment addressing and the segment redirect route"""
+
+import re
+import unittest
+
+import pytest
+
+
+class TestSegmentTemplate(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _flow(self, tams, invoke_route):
+        self.invoke_route = invoke_route
+        _, flows = tams[0].add_source("single", 50)
+        self.flow_id = flows[0]["id"]
+        self.segments = tams[0].segments[self.flow_id]
+
+    def test_mpd_size_follows_timeline_runs(self):
+        response, mpd = self.invoke_route(f"/flows/{self.flow_id}/manifest.mpd")
+        self.assertEqual(response["statusCode"], 200)
+        self.assertIn(f'media="/flows/{self.flow_id}/segment/$Time$"', mpd)
+        self.assertNotIn("<SegmentURL", mpd)
+        self.assertEqual(mpd.count("<S "), 1)
+
+    def test_time_redirects_to_segment(self):
+        _, mpd = self.invoke_route(f"/flows/{self.flow_id}/manifest.mpd")
+        start, duration = map(int, re.search(r'<S t="(\d+)" d="(\d+)"', mpd).groups())
+        response, _ = self.invoke_route(
+            f"/flows/{self.flow_id}/segment/{start + 3 * duration}"
+        )
+        self.assertEqual(response["statusCode"], 302)
+        self.assertEqual(
+            response["headers"]["Location"], self.segments[3]["get_urls"][0]["url"]
+        )
+
+    def test_time_between_segment_starts_is_not_found(self):
+        _, mpd = self.invoke_route(f"/flows/{self.flow_id}/manifest.mpd")
+        start = int(re.search(r'<S t="(\d+)"', mpd).group(1))
+        for segment_start in (str(start + 2), "later"):
+            response, _ = self.invoke_route(
+                f"/flows/{self.flow_id}/segment/{segment_start}"
+            )
+            self.assertEqual(response["statusCode"], 404)
@@ -0,0 +1,75 @@
+"""Rolling segment windows and delta updates of live segment playlists"""
+
+import unittest
+from unittest import mock
+
+import pytest
+from mediatimestamp.immutable import TimeRange
+
+
+def get_object_ids(timed_segments):
+    return [segment["object_id"] for segment, _ in timed_segments]
+
+
+class TestRollingWindow(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _live_flow(self, tams, hls_app):
+        self.stand_in = tams[0]
+        self.app = hls_app
+        _, flows = self.stand_in.add_source("single", 10, live=True)
+        self.flow_id = flows[0]["id"]
+        # The function is loaded with its container caches disabled, so the window gets its own
+        window_cache = hls_app.TTLCache(max_size=4, ttls={"SegmentWindow": 60})
+        with mock.patch.object(hls_app, "segment_window_cache", window_cache):
+            yield
+
+    def test_refresh_only_fetches_segments_after_the_window(self):
+        window = self.app.refresh_segment_window(self.flow_id, 10)
+        added = self.stand_in.append_segments(self.flow_id, 3)
+        with mock.patch.object(
+            self.app, "get_timed_segments", wraps=self.app.get_timed_segments
+        ) as get_timed_segments:
+            refreshed = self.app.refresh_segment_window(self.flow_id, 10)
+        get_timed_segments.assert_called_once_with(
+            self.flow_id, 10, str(TimeRange.from_start(window[-1][1].end))
+        )
+        self.assertEqual(
+            get_object_ids(refreshed),
+            get_object_ids(window[3:]) + [segment["object_id"] for segment in added],
+        )
+
+    def test_window_size_change_fetches_the_whole_window(self):
+        self.app.refresh_segment_window(self.flow_id, 10)
+        with mock.patch.object(
+            self.app, "get_timed_segments", wraps=self.app.get_timed_segments
+        ) as get_timed_segments:
+            refreshed = self.app.refresh_segment_window(self.flow_id, 4)
+        get_timed_segments.assert_called_once_with(self.flow_id, 4)
+        self.assertEqual(len(refreshed), 4)
+
+
+class TestDeltaPlaylist(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _flows(self, tams, invoke_route):
+        self.invoke_route = invoke_route
+        _, live_flows = tams[0].add_source("single", 40, live=True)
+        _, vod_flows = tams[0].add_source("single", 40)
+        self.live_path = f"/flows/{live_flows[0]['id']}/segments/manifest.m3u8"
+        self.vod_path = f"/flows/{vod_flows[0]['id']}/segments/manifest.m3u8"
+
+    def test_skip_request_replaces_older_segments(self):
+        _, playlist = self.invoke_route(self.live_path)
+        response, delta = self.invoke_route(self.live_path, {"_HLS_skip": "YES"})
+        self.assertEqual(response["statusCode"], 200)
+        # Six target durations of 2 seconds may be skipped, so the last 6 of 40 segments are kept
+        self.assertIn("CAN-SKIP-UNTIL=12", playlist)
+        self.assertNotIn("#EXT-X-SKIP", playlist)
+        self.assertIn("#EXT-X-SKIP:SKIPPED-SEGMENTS=34\n", delta)
+        self.assertEqual(delta.count("#EXTINF"), 6)
+        self.assertEqual(playlist.splitlines()[-12:], delta.splitlines()[-12:])
+
+    def test_vod_playlist_ignores_skip_request(self):
+        response, playlist = self.invoke_route(self.vod_path, {"_HLS_skip": "YES"})
+        self.assertEqual(response["statusCode"], 200)
+        self.assertNotIn("#EXT-X-SKIP", playlist)
+        self.assertEqual(playlist.count("#EXTINF"), 40)
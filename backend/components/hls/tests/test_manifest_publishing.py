@@ -0,0 +1,83 @@
+"""Publishing of pre-rendered manifests from TAMS flow events"""
+
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import pytest
+from benchmark.run import Context
+from botocore.exceptions import ClientError
+
+
+class FakeManifestBucket:
+    """The S3 calls made on the manifest bucket, with missing keys reported as they are when
+    the function can list the bucket"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Key, Body, Metadata, **_):
+        self.objects[Key] = (Body.decode(), Metadata)
+
+    def head_object(self, Key, **_):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"Metadata": self.objects[Key][1]}
+
+    def delete_objects(self, Delete, **_):
+        for item in Delete["Objects"]:
+            self.objects.pop(item["Key"], None)
+
+    def delete_object(self, Key, **_):
+        self.objects.pop(Key, None)
+
+
+def send_event(app, detail_type, detail):
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.render_handler({"detail-type": detail_type, "detail": detail}, Context())
+
+
+class TestFlowDeleted(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _published_ladder(self, tams, hls_app):
+        self.stand_in = tams[0]
+        self.app = hls_app
+        self.bucket = FakeManifestBucket()
+        with (
+            mock.patch.object(hls_app, "s3", self.bucket),
+            mock.patch.object(hls_app, "manifest_bucket", "manifests"),
+        ):
+            self.source_id, flows = self.stand_in.add_source("ladder", 5)
+            self.multi = next(flow for flow in flows if flow.get("flow_collection"))
+            for item in self.multi["flow_collection"]:
+                self.stand_in.flows[item["id"]]["collected_by"] = [self.multi["id"]]
+            for flow in flows:
+                send_event(hls_app, "flows/created", {"flow": flow})
+            yield
+
+    def delete_flow(self, flow_id):
+        del self.stand_in.flows[flow_id]
+        self.multi["flow_collection"] = [
+            item for item in self.multi["flow_collection"] if item["id"] != flow_id
+        ]
+        send_event(self.app, "flows/deleted", {"flow_id": flow_id})
+
+    def test_cold_container_removes_flow_from_parent_masters(self):
+        child_id = self.multi["flow_collection"][0]["id"]
+        source_key = f"sources/{self.source_id}/manifest.m3u8"
+        multi_key = f"flows/{self.multi['id']}/manifest.m3u8"
+        self.assertIn(child_id, self.bucket.objects[multi_key][0])
+        # The container caches are disabled, so the relations come from the published manifest
+        self.delete_flow(child_id)
+        self.assertNotIn(f"flows/{child_id}/manifest.m3u8", self.bucket.objects)
+        self.assertNotIn(
+            f"flows/{child_id}/segments/manifest.m3u8", self.bucket.objects
+        )
+        self.assertNotIn(child_id, self.bucket.objects[multi_key][0])
+        self.assertNotIn(child_id, self.bucket.objects[source_key][0])
+
+    def test_unpublished_flow_is_deleted_without_error(self):
+        self.bucket.objects.clear()
+        self.delete_flow(self.multi["flow_collection"][0]["id"])
+        self.assertEqual(self.bucket.objects, {})
@@ -0,0 +1,56 @@
+"""Validators, cache lifetimes and content encoding of manifest responses"""
+
+import unittest
+
+import pytest
+
+
+class TestManifestResponses(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _flows(self, tams, hls_app, invoke_route):
+        self.app = hls_app
+        self.invoke_route = invoke_route
+        _, live_flows = tams[0].add_source("single", 10, live=True)
+        _, vod_flows = tams[0].add_source("single", 10)
+        self.live_path = f"/flows/{live_flows[0]['id']}/segments/manifest.m3u8"
+        self.vod_path = f"/flows/{vod_flows[0]['id']}/segments/manifest.m3u8"
+
+    def test_matching_etag_is_not_modified(self):
+        response, body = self.invoke_route(self.vod_path)
+        etag = response["headers"]["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+        revalidated, revalidated_body = self.invoke_route(
+            self.vod_path, headers={"if-none-match": etag}
+        )
+        self.assertEqual(revalidated["statusCode"], 304)
+        self.assertEqual(revalidated["headers"]["ETag"], etag)
+        self.assertEqual(revalidated_body, "")
+        self.assertTrue(body)
+
+    def test_other_etag_is_served_in_full(self):
+        response, _ = self.invoke_route(
+            self.vod_path, headers={"if-none-match": 'W/"other"'}
+        )
+        self.assertEqual(response["statusCode"], 200)
+
+    def test_vod_playlist_is_cached_longer_than_live(self):
+        vod, _ = self.invoke_route(self.vod_path)
+        live, _ = self.invoke_route(self.live_path)
+        vod_max_age = min(
+            self.app.manifest_cache_max_age, self.app.presigned_url_expiry // 2
+        )
+        self.assertEqual(vod["headers"]["Cache-Control"], f"max-age={vod_max_age}")
+        # Live playlists only live for half a target duration
+        self.assertEqual(live["headers"]["Cache-Control"], "max-age=1")
+
+    def test_body_is_only_compressed_when_accepted(self):
+        compressed, compressed_body = self.invoke_route(self.vod_path)
+        plain, plain_body = self.invoke_route(
+            self.vod_path, headers={"accept-encoding": "identity"}
+        )
+        self.assertEqual(compressed["headers"].get("Content-Encoding"), "gzip")
+        self.assertNotIn("Content-Encoding", plain["headers"])
+        self.assertEqual(compressed_body, plain_body)
+        self.assertEqual(
+            compressed["headers"]["ETag"], plain["headers"]["ETag"], "weak ETag"
+        )
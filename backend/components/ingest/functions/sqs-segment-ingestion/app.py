@@ -1,5 +1,8 @@
+import concurrent.futures
 import json
 import os
+import threading
+from collections import defaultdict
 from datetime import datetime
 from urllib.parse import urlparse
 
@@ -23,17 +26,43 @@ metrics = Metrics()
 batch_processor = BatchProcessor(event_type=EventType.SQS)
 
 IMAGE_FORMAT = "urn:x-tam:format:image"
+# Operational fields of a message that are not part of the TAMS segment schema
+OPERATIONAL_FIELDS = {"flowId", "flowFormat", "uri", "deleteSource", "byterange"}
 s3 = boto3.client("s3")
 endpoint = os.environ["TAMS_ENDPOINT"]
+record_workers = int(os.environ.get("RECORD_WORKERS", "1"))
 creds = Credentials(
     scopes=["tams-api/read", "tams-api/write"],
     secret_arn=os.environ["SECRET_ARN"],
 )
+# Storage allocated for the current batch by message ID, None where the flow was not found
+batch_media_objects: dict[str, dict | None] = {}
+# Uploaded segments of the current batch waiting to be registered, as (message ID, message) by flow
+batch_segments: defaultdict[str, list[tuple[str, dict]]] = defaultdict(list)
+# The format of a flow never changes, so formats are kept for the life of the container
+flow_formats: dict[str, str] = {}
+flow_format_fetches: dict[str, concurrent.futures.Future] = {}
+flow_formats_lock = threading.Lock()
+
+
+class SourceStream:
+    """Readable view of a source file whose length is known, so it can be streamed into a pre-signed PUT with a Content-Length"""
+
+    def __init__(self, body, length: int, close=None) -> None:
+        self._body = body
+        self._length = length
+        self.close = close or body.close
+
+    def read(self, size: int = -1) -> bytes:
+        return self._body.read(None if size is None or size < 0 else size)
+
+    def __len__(self) -> int:
+        return self._length
 
 
 @tracer.capture_method(capture_response=False)
-def get_file(source: str, byterange: str | None = None) -> bytes:
-    """Reads the content of a file from the supplied source uri"""
+def get_file(source: str, byterange: str | None = None) -> bytes | SourceStream:
+    """Opens a file from the supplied source uri. Files of known length are returned as a stream, others are read into memory"""
     source_parse = urlparse(source)
     if byterange:
         byterange_len, byterange_start = map(int, byterange.split("@"))
@@ -48,30 +77,41 @@ def get_file(source: str, byterange: str | None = None) -> bytes:
                 params["Range"] = range_string
             try:
                 response = s3.get_object(**params)
-                return response["Body"].read()
+                return SourceStream(response["Body"], response["ContentLength"])
             except s3.exceptions.NoSuchKey as ex:
                 logger.error("NoSuchKey", error=ex.response["Error"])
                 return None
         case "https" | "http":
             headers = {"Range": f"bytes={range_string}"} if byterange else None
-            response = requests.get(source, headers=headers, timeout=30)
+            response = requests.get(source, headers=headers, timeout=30, stream=True)
             response.raise_for_status()
+            # The raw body is only the file itself when it is sent without a content encoding
+            if "Content-Length" in response.headers and not response.headers.get(
+                "Content-Encoding"
+            ):
+                return SourceStream(
+                    response.raw,
+                    int(response.headers["Content-Length"]),
+                    close=response.close,
+                )
             return response.content
         case _:
             raise ValueError(f"Unsupported URL scheme in '{source}'")
 
 
 @tracer.capture_method(capture_response=False)
-def upload_file(flow_id: str, data: bytes, object_id: str | None) -> dict:
-    """Uploads a file to the TAMS API"""
-    logger.info("Requesting pre-signed PUT URL...")
+def get_media_objects(
+    flow_id: str, object_ids: list[str] | None = None, limit: int = 1
+) -> list[dict] | None:
+    """Requests storage in a flow for the given object ids, or for a number of new objects. Returns None if the flow does not exist"""
+    logger.info("Requesting pre-signed PUT URLs...")
     get_url = requests.post(
         f"{endpoint}/flows/{flow_id}/storage",
         headers={
             "Content-Type": "application/json",
             "Authorization": f"Bearer {creds.token()}",
         },
-        data=json.dumps({"object_ids": [object_id]} if object_id else {"limit": 1}),
+        data=json.dumps({"object_ids": object_ids} if object_ids else {"limit": limit}),
         timeout=30,
     )
     try:
@@ -81,20 +121,13 @@ def upload_file(flow_id: str, data: bytes, object_id: str | None) -> dict:
         if ex.response.status_code == 404:
             logger.error(ex.response.text)
             return None
-        elif ex.response.status_code == 400 and object_id:
-            try:
-                error_data = ex.response.json()
-                if "already exist" in error_data.get("message", ""):
-                    logger.info(
-                        f"Object ID {object_id} already exists, skipping upload"
-                    )
-                    return {"object_id": object_id}
-            except (ValueError, KeyError):
-                pass
-            raise ex
-        else:
-            raise ex
-    media_object = get_url.json()["media_objects"][0]
+        raise ex
+    return get_url.json()["media_objects"]
+
+
+@tracer.capture_method(capture_response=False)
+def put_file(media_object: dict, data: bytes | SourceStream) -> None:
+    """Puts a file into storage using the pre-signed URL of a media object"""
     logger.info("Using pre-signed URL to put file in S3...")
     put_file = requests.put(
         media_object["put_url"]["url"],
@@ -104,15 +137,126 @@ def upload_file(flow_id: str, data: bytes, object_id: str | None) -> dict:
     )
     put_file.raise_for_status()
     logger.info(f"Response status: {put_file.status_code}")
+
+
+@tracer.capture_method(capture_response=False)
+def upload_file(
+    flow_id: str, data: bytes | SourceStream, object_id: str | None
+) -> dict:
+    """Uploads a file to the TAMS API"""
+    try:
+        media_objects = get_media_objects(flow_id, [object_id] if object_id else None)
+    except requests.exceptions.HTTPError as ex:
+        if ex.response.status_code == 400 and object_id:
+            try:
+                error_data = ex.response.json()
+                if "already exist" in error_data.get("message", ""):
+                    logger.info(
+                        f"Object ID {object_id} already exists, skipping upload"
+                    )
+                    return {"object_id": object_id}
+            except (ValueError, KeyError):
+                pass
+        raise ex
+    if media_objects is None:
+        return None
+    media_object = media_objects[0]
+    put_file(media_object, data)
     return media_object
 
 
+@tracer.capture_method(capture_response=False)
+def is_source_readable(source: str) -> bool:
+    """Checks that a source file exists without reading it, so storage is not allocated for a record that cannot be uploaded"""
+    source_parse = urlparse(source)
+    try:
+        match source_parse.scheme:
+            case "s3":
+                s3.head_object(Bucket=source_parse.netloc, Key=source_parse.path[1:])
+                return True
+            case "https" | "http":
+                response = requests.head(source, timeout=30, allow_redirects=True)
+                # Servers that do not support HEAD are left for the GET to find out
+                return response.ok or response.status_code in (405, 501)
+    except (ClientError, requests.exceptions.RequestException) as ex:
+        logger.warning(f"Unable to read source file {source}: {ex}")
+    return False
+
+
+@tracer.capture_method(capture_response=False)
+def allocate_storage(records: list[dict]) -> dict[str, dict | None]:
+    """Requests storage for the records of a batch with one request per flow, returning the media objects by message ID.
+    Records left out, because their source cannot be read, their request failed or they could not be parsed, fall back to upload_file
+    once record_handler has opened their source."""
+    parsed_records = []
+    for record in records:
+        try:
+            message = json.loads(record["body"])
+            parsed_records.append(
+                (
+                    record["messageId"],
+                    message["flowId"],
+                    message["uri"],
+                    message.get("object_id"),
+                )
+            )
+        except (ValueError, KeyError):
+            continue
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(record_workers, 1)
+    ) as executor:
+        readable = list(
+            executor.map(is_source_readable, [uri for _, _, uri, _ in parsed_records])
+        )
+    flow_records = defaultdict(lambda: ([], []))
+    for (message_id, flow_id, _, object_id), source_readable in zip(
+        parsed_records, readable
+    ):
+        if not source_readable:
+            continue
+        # Records naming their object ids and records needing new ones are requested separately
+        flow_records[flow_id][0 if object_id else 1].append((message_id, object_id))
+    allocations = {}
+    for flow_id, (named_records, unnamed_records) in flow_records.items():
+        for group, request in (
+            (
+                named_records,
+                {"object_ids": [object_id for _, object_id in named_records]},
+            ),
+            (unnamed_records, {"limit": len(unnamed_records)}),
+        ):
+            if not group:
+                continue
+            try:
+                media_objects = get_media_objects(flow_id, **request)
+            except requests.exceptions.RequestException as ex:
+                # Existing object ids are rejected for the whole request, so leave each record to upload_file
+                logger.warning(f"Unable to allocate storage for flow {flow_id}: {ex}")
+                continue
+            if media_objects is None:
+                allocations.update((message_id, None) for message_id, _ in group)
+            elif request.get("object_ids"):
+                by_object_id = {
+                    media_object["object_id"]: media_object
+                    for media_object in media_objects
+                }
+                allocations.update(
+                    (message_id, by_object_id[object_id])
+                    for message_id, object_id in group
+                    if object_id in by_object_id
+                )
+            else:
+                allocations.update(
+                    (message_id, media_object)
+                    for (message_id, _), media_object in zip(group, media_objects)
+                )
+    return allocations
+
+
 @tracer.capture_method(capture_response=False)
 def post_segment(flow_id: str, segment_data: dict) -> bool:
     """Register the segment with the TAMS API"""
-    # Exclude operational fields that are not part of the TAMS segment schema
-    excluded_fields = {"flowId", "uri", "deleteSource", "byterange"}
-    segment = {k: v for k, v in segment_data.items() if k not in excluded_fields}
+    segment = {k: v for k, v in segment_data.items() if k not in OPERATIONAL_FIELDS}
 
     logger.info("Posting segment to TAMS...")
     post = requests.post(
@@ -136,6 +280,72 @@ def post_segment(flow_id: str, segment_data: dict) -> bool:
     return True
 
 
+@tracer.capture_method(capture_response=False)
+def post_segments(flow_id: str, segments_data: list[dict]) -> list[int] | None:
+    """Register several segments of a flow with one request. Returns the positions of the segments that failed, or None if the request was rejected as a whole"""
+    segments = [
+        {k: v for k, v in segment_data.items() if k not in OPERATIONAL_FIELDS}
+        for segment_data in segments_data
+    ]
+
+    logger.info(f"Posting {len(segments)} segments to TAMS...")
+    post = requests.post(
+        f"{endpoint}/flows/{flow_id}/segments",
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {creds.token()}",
+        },
+        data=json.dumps(segments),
+        timeout=30,
+    )
+    try:
+        post.raise_for_status()
+        logger.info(f"Response status: {post.status_code}")
+    except requests.exceptions.HTTPError as ex:
+        if ex.response.status_code == 400:
+            logger.error(ex.response.text)
+            return None
+        else:
+            raise ex
+    if post.status_code == 201:
+        return []
+    # Segments that could not be created are listed in a 200 response
+    failed_segments = post.json().get("failed_segments", [])
+    if failed_segments:
+        logger.error("Some segments failed to be posted", failed=failed_segments)
+    # Matched on object_id, as TAMS may write the timerange of a failed segment in another form
+    failed_object_ids = {
+        failed_segment.get("object_id") for failed_segment in failed_segments
+    }
+    return [
+        i
+        for i, segment in enumerate(segments)
+        if segment["object_id"] in failed_object_ids
+    ]
+
+
+@tracer.capture_method(capture_response=False)
+def register_segments(flow_id: str, records: list[tuple[str, dict]]) -> list[str]:
+    """Registers the uploaded segments of a flow, using one request where there are several, and deletes their sources if requested.
+    Returns the message IDs of the segments that failed"""
+    messages = [message for _, message in records]
+    if len(messages) == 1:
+        failed = [] if post_segment(flow_id, messages[0]) else [0]
+    else:
+        failed = post_segments(flow_id, messages)
+        if failed is None:
+            # Post each segment to find the ones that caused the request to be rejected
+            failed = [
+                i
+                for i, message in enumerate(messages)
+                if not post_segment(flow_id, message)
+            ]
+    for i, message in enumerate(messages):
+        if i not in failed and message.get("deleteSource", False):
+            delete_s3_file(message["uri"])
+    return [records[i][0] for i in failed]
+
+
 @tracer.capture_method(capture_response=False)
 def delete_s3_file(source: str) -> None:
     """Attempts to delete the S3 file using the supplied source uri, logs error without raising if unable to do so."""
@@ -149,8 +359,8 @@ def delete_s3_file(source: str) -> None:
 
 
 @tracer.capture_method(capture_response=False)
-def get_flow_format(flow_id: str) -> str:
-    """Get the format of a flow"""
+def fetch_flow_format(flow_id: str) -> str:
+    """Get the format of a flow from the TAMS API"""
     response = requests.get(
         f"{endpoint}/flows/{flow_id}",
         headers={"Authorization": f"Bearer {creds.token()}"},
@@ -160,6 +370,35 @@ def get_flow_format(flow_id: str) -> str:
     return response.json()["format"]
 
 
+@tracer.capture_method(capture_response=False)
+def get_flow_format(flow_id: str) -> str:
+    """Get the format of a flow, from the container cache where possible. Concurrent requests for the same flow share a single fetch"""
+    with flow_formats_lock:
+        if flow_id in flow_formats:
+            return flow_formats[flow_id]
+        fetch = flow_format_fetches.get(flow_id)
+        if fetch is None:
+            fetch = flow_format_fetches[flow_id] = concurrent.futures.Future()
+            fetching = True
+        else:
+            fetching = False
+    if not fetching:
+        return fetch.result()
+    try:
+        flow_format = fetch_flow_format(flow_id)
+    # pylint: disable=broad-exception-caught
+    except Exception as ex:
+        with flow_formats_lock:
+            del flow_format_fetches[flow_id]
+        fetch.set_exception(ex)
+        raise
+    with flow_formats_lock:
+        flow_formats[flow_id] = flow_format
+        del flow_format_fetches[flow_id]
+    fetch.set_result(flow_format)
+    return flow_format
+
+
 @tracer.capture_method(capture_response=False)
 def record_handler(record: SQSRecord) -> None:
     """Processes a single SQS record"""
@@ -182,21 +421,70 @@ def record_handler(record: SQSRecord) -> None:
         )
     flow_id = message["flowId"]
     file_data = get_file(message["uri"], message.get("byterange"))
-    if not file_data:
-        raise ValueError(f"Unable to read source file {message['uri']}")
-    media_object = upload_file(flow_id, file_data, message.get("object_id"))
+    try:
+        if not file_data:
+            raise ValueError(f"Unable to read source file {message['uri']}")
+        if record.message_id in batch_media_objects:
+            media_object = batch_media_objects.pop(record.message_id)
+            if media_object is not None:
+                put_file(media_object, file_data)
+        else:
+            media_object = upload_file(flow_id, file_data, message.get("object_id"))
+    finally:
+        if isinstance(file_data, SourceStream):
+            file_data.close()
     if media_object is None:
         raise ValueError(f"Unable to upload file to flow {flow_id}")
+    if message.get("flowFormat"):
+        # Producers that know the format of the flow can save the lookup
+        with flow_formats_lock:
+            flow_formats.setdefault(flow_id, message["flowFormat"])
     flow_format = get_flow_format(flow_id)
     if flow_format == IMAGE_FORMAT and "_" in message["timerange"]:
         message["timerange"] = f"{message['timerange'].split('_')[0]}]"
     # Update object_id in message to use the actual uploaded object_id
     message["object_id"] = media_object["object_id"]
-    post_result = post_segment(flow_id, message)
-    if not post_result:
-        raise ValueError(f"Unable to post segment to flow {flow_id}")
-    if message.get("deleteSource", False):
-        delete_s3_file(message["uri"])
+    # Segments are registered per flow once the whole batch has been uploaded
+    batch_segments[flow_id].append((record.message_id, message))
+
+
+@tracer.capture_method(capture_response=False)
+def process_records_concurrently(records: list[dict]) -> dict:
+    """Processes the records of a batch with a bounded worker pool and returns a partial batch response.
+    Records for different flows are processed in parallel, records for the same flow in order by one worker"""
+    flow_records = defaultdict(list)
+    for record in map(SQSRecord, records):
+        try:
+            flow_id = json.loads(record.body)["flowId"]
+        except (ValueError, KeyError):
+            flow_id = record.message_id  # Fails in record_handler, on its own
+        flow_records[flow_id].append(record)
+
+    def process_flow_records(flow_batch: list[SQSRecord]) -> list[str]:
+        failed_message_ids = []
+        for record in flow_batch:
+            try:
+                record_handler(record)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception(f"Failed to process record {record.message_id}")
+                failed_message_ids.append(record.message_id)
+        return failed_message_ids
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(record_workers, len(flow_records))
+    ) as executor:
+        failed_message_ids = [
+            message_id
+            for flow_failures in executor.map(
+                process_flow_records, flow_records.values()
+            )
+            for message_id in flow_failures
+        ]
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in failed_message_ids
+        ]
+    }
 
 
 @logger.inject_lambda_context(log_event=True)
@@ -204,9 +492,25 @@ def record_handler(record: SQSRecord) -> None:
 @metrics.log_metrics(capture_cold_start_metric=True)
 # pylint: disable=unused-argument
 def lambda_handler(event: SQSEvent, context: LambdaContext) -> dict:
-    return process_partial_response(
-        event=event,
-        record_handler=record_handler,
-        processor=batch_processor,
-        context=context,
-    )
+    batch_media_objects.clear()
+    batch_segments.clear()
+    batch_media_objects.update(allocate_storage(event["Records"]))
+    if record_workers > 1 and event["Records"]:
+        response = process_records_concurrently(event["Records"])
+    else:
+        response = process_partial_response(
+            event=event,
+            record_handler=record_handler,
+            processor=batch_processor,
+            context=context,
+        )
+    for flow_id, records in batch_segments.items():
+        try:
+            failed_message_ids = register_segments(flow_id, records)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception(f"Unable to post segments to flow {flow_id}")
+            failed_message_ids = [message_id for message_id, _ in records]
+        response["batchItemFailures"].extend(
+            {"itemIdentifier": message_id} for message_id in failed_message_ids
+        )
+    return response
@@ -1,10 +1,15 @@
+import bisect
+import concurrent.futures
 import json
 import os
+import threading
+import time
 import uuid
-from collections import defaultdict
-from collections.abc import Generator
+from collections import Counter, defaultdict
+from collections.abc import Callable, Generator
 from typing import Any
 
+import boto3
 import requests
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.logging import correlation_paths
@@ -12,13 +17,26 @@ from aws_lambda_powertools.utilities.data_classes.event_bridge_event import (
     EventBridgeEvent,
 )
 from aws_lambda_powertools.utilities.typing import LambdaContext
+from botocore.exceptions import ClientError
 from mediatimestamp.immutable import TimeRange, Timestamp
 from openid_auth import Credentials
 
 tracer = Tracer()
 logger = Logger()
+s3 = boto3.client("s3")
+sfn = boto3.client("stepfunctions")
 
 endpoint = os.environ["TAMS_ENDPOINT"]
+segment_fetch_workers = int(os.environ.get("SEGMENT_FETCH_WORKERS", "8"))
+segment_fetch_flows = max(int(os.environ.get("SEGMENT_FETCH_FLOWS", "4")), 1)
+segment_post_workers = int(os.environ.get("SEGMENT_POST_WORKERS", "4"))
+segment_post_retries = int(os.environ.get("SEGMENT_POST_RETRIES", "3"))
+segment_index_max_gap = Timestamp.from_float(
+    float(os.environ.get("SEGMENT_INDEX_MAX_GAP", "60"))
+)
+edit_shard_size = int(os.environ.get("EDIT_SHARD_SIZE", "0"))
+state_machine_arn = os.environ.get("STATE_MACHINE_ARN", "")
+checkpoint_bucket = os.environ.get("CHECKPOINT_BUCKET", "")
 creds = Credentials(
     scopes=["tams-api/read", "tams-api/write"], secret_arn=os.environ["SECRET_ARN"]
 )
@@ -28,6 +46,8 @@ FORMAT_VIDEO = "urn:x-nmos:format:video"
 FORMAT_MULTI = "urn:x-nmos:format:multi"
 DEFAULT_START_TIME = "0:0"
 DEFAULT_DESCRIPTION = "Edit By Reference"
+MAX_PAYLOAD_SIZE = 6 * 1024 * 1024  # API Gateway payload limit (6MB to be safe)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
 @tracer.capture_method(capture_response=False)
@@ -108,67 +128,361 @@ def get_segments(flow_id: str, timerange: str) -> Generator[dict[str, Any], None
 
 
 @tracer.capture_method(capture_response=False)
-def post_segment_chunk(flow_id: str, segment_chunk: list) -> None:
+def coalesce_timeranges(timeranges: list[str], max_gap: Timestamp) -> list[TimeRange]:
     """
-    Post a chunk of segments to a flow.
+    Merge timeranges that overlap or are separated by less than a gap.
+
+    Args:
+        timeranges: The timerange strings to merge
+        max_gap: The largest gap between two timeranges that is fetched rather than split
+
+    Returns:
+        The merged timeranges, in order of start
+    """
+    parsed = sorted(
+        (
+            timerange
+            for timerange in map(TimeRange.from_str, timeranges)
+            if not timerange.is_empty()
+        ),
+        key=lambda timerange: (timerange.start is not None, timerange.start),
+    )
+    merged = []
+    for timerange in parsed:
+        if merged and (
+            merged[-1].end is None or timerange.start <= merged[-1].end + max_gap
+        ):
+            merged[-1] = merged[-1].extend_to_encompass_timerange(timerange)
+        else:
+            merged.append(timerange)
+    return merged
+
+
+@tracer.capture_method(capture_response=False)
+def build_segment_index(
+    segment_lists: list[list[dict[str, Any]]],
+) -> tuple[list[Timestamp], list[tuple[TimeRange, dict[str, Any]]]]:
+    """
+    Build a lookup index from the segments fetched for one flow.
+
+    Args:
+        segment_lists: The segments returned for each fetched timerange of the flow
+
+    Returns:
+        A tuple of (segment_starts, entries) where entries pairs each segment with its
+        parsed timerange, both sorted by start
+    """
+    entries = []
+    for segment in (segment for segments in segment_lists for segment in segments):
+        entries.append((TimeRange.from_str(segment["timerange"]), segment))
+    entries.sort(key=lambda entry: entry[0].start)
+    # A segment straddling two fetched timeranges is returned for both
+    entries = [
+        entry
+        for i, entry in enumerate(entries)
+        if i == 0 or entry[0] != entries[i - 1][0]
+    ]
+    return [timerange.start for timerange, _ in entries], entries
+
+
+@tracer.capture_method(capture_response=False)
+def lookup_segments(
+    segment_index: tuple[list[Timestamp], list[tuple[TimeRange, dict[str, Any]]]],
+    timerange: str,
+) -> list[dict[str, Any]]:
+    """
+    Find the indexed segments that overlap a timerange, as the TAMS API would return them.
+
+    Args:
+        segment_index: The index returned by build_segment_index
+        timerange: The timerange string to look up
+
+    Returns:
+        The overlapping segment dictionaries, in order of start
+    """
+    segment_starts, entries = segment_index
+    lookup_timerange = TimeRange.from_str(timerange)
+    first, last = 0, len(entries)
+    # Segments in a flow do not overlap, so only the one starting before the lookup can reach into it
+    if lookup_timerange.start is not None:
+        first = max(bisect.bisect_right(segment_starts, lookup_timerange.start) - 1, 0)
+    if lookup_timerange.end is not None:
+        last = bisect.bisect_right(segment_starts, lookup_timerange.end)
+    return [
+        segment
+        for segment_timerange, segment in entries[first:last]
+        if segment_timerange.overlaps_with_timerange(lookup_timerange)
+    ]
+
+
+@tracer.capture_method(capture_response=False)
+def get_flow_segment_indexes(
+    flow_timeranges: dict[str, list[str]],
+) -> Generator[
+    tuple[str, tuple[list[Timestamp], list[tuple[TimeRange, dict[str, Any]]]]],
+    None,
+    None,
+]:
+    """
+    Fetch the segments of each flow over the union of its timeranges using a bounded worker pool.
+
+    Only a few flows are fetched ahead of the one being processed, so at most that many flow
+    indexes are held at once rather than one for every flow in the edit.
+
+    Args:
+        flow_timeranges: A dictionary mapping flow IDs to the timeranges needed from them
+
+    Yields:
+        Tuples of (flow_id, segment_index), in the order the fetches of each flow complete
+    """
+    fetch_timeranges = (
+        (flow_id, coalesce_timeranges(timeranges, segment_index_max_gap))
+        for flow_id, timeranges in flow_timeranges.items()
+    )
+    creds.token()  # Refresh the token once rather than in every worker
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=segment_fetch_workers)
+    flow_futures = {}
+
+    def submit_next_flow() -> None:
+        for flow_id, timeranges in fetch_timeranges:
+            if timeranges:
+                flow_futures[flow_id] = [
+                    executor.submit(
+                        lambda *args: list(get_segments(*args)),
+                        flow_id,
+                        str(timerange),
+                    )
+                    for timerange in timeranges
+                ]
+                return
+
+    try:
+        for _ in range(segment_fetch_flows):
+            submit_next_flow()
+        while flow_futures:
+            concurrent.futures.wait(
+                [
+                    future
+                    for futures in flow_futures.values()
+                    for future in futures
+                    if not future.done()
+                ],
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for flow_id, futures in list(flow_futures.items()):
+                if all(future.done() for future in futures):
+                    del flow_futures[flow_id]
+                    # Keep fetching while this flow is processed
+                    submit_next_flow()
+                    yield (
+                        flow_id,
+                        build_segment_index([future.result() for future in futures]),
+                    )
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+@tracer.capture_method(capture_response=False)
+def is_chunk_posted(flow_id: str, segment_chunk: list[str]) -> bool:
+    """
+    Check whether every segment of a chunk is already registered on a flow.
 
     Args:
         flow_id: The unique identifier of the flow
-        segment_chunk: A list of segment dictionaries to post
+        segment_chunk: A list of JSON serialised segments, in order of start
+
+    Returns:
+        True if the flow has a segment with the same object and timerange for each one
     """
-    post = requests.post(
-        f"{endpoint}/flows/{flow_id}/segments",
-        headers={
-            "Authorization": f"Bearer {creds.token()}",
-            "Content-Type": "application/json",
-        },
-        data=json.dumps(segment_chunk),
-        timeout=30,
+    chunk_segments = {
+        (segment["object_id"], TimeRange.from_str(segment["timerange"]))
+        for segment in map(json.loads, segment_chunk)
+    }
+    chunk_timerange = TimeRange.from_str(json.loads(segment_chunk[0])["timerange"])
+    chunk_timerange = chunk_timerange.extend_to_encompass_timerange(
+        TimeRange.from_str(json.loads(segment_chunk[-1])["timerange"])
     )
+    flow_segments = {
+        (segment["object_id"], TimeRange.from_str(segment["timerange"]))
+        for segment in get_segments(flow_id, str(chunk_timerange))
+    }
+    return chunk_segments <= flow_segments
+
+
+@tracer.capture_method(capture_response=False)
+def post_segment_chunk(
+    flow_id: str, segment_chunk: list[str], maybe_posted: bool = False
+) -> None:
+    """
+    Post a chunk of segments to a flow, retrying throttling, server errors and connection failures.
+
+    Posting is not idempotent: an attempt that timed out may still have registered the chunk,
+    and the retry is then rejected as overlapping. A 400 on a retry is therefore taken as
+    success when every segment of the chunk is found on the flow.
+
+    Args:
+        flow_id: The unique identifier of the flow
+        segment_chunk: A list of JSON serialised segments to post
+        maybe_posted: Whether an earlier run may have posted the chunk, in which case a 400 on
+            the first attempt is checked in the same way
+    """
+    logger.info(f"Posting chunk of {len(segment_chunk)} segments for flow {flow_id}")
+    data = f"[{','.join(segment_chunk)}]"
+    for attempt in range(segment_post_retries + 1):
+        retry = attempt < segment_post_retries
+        try:
+            post = requests.post(
+                f"{endpoint}/flows/{flow_id}/segments",
+                headers={
+                    "Authorization": f"Bearer {creds.token()}",
+                    "Content-Type": "application/json",
+                },
+                data=data,
+                timeout=30,
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not retry:
+                raise
+            logger.warning(
+                "Retrying segment chunk", extra={"flow_id": flow_id, "error": str(e)}
+            )
+        else:
+            if post.status_code not in RETRYABLE_STATUS_CODES or not retry:
+                break
+            logger.warning(
+                "Retrying segment chunk",
+                extra={"flow_id": flow_id, "status_code": post.status_code},
+            )
+        time.sleep(2**attempt)
+    if (
+        post.status_code == 400
+        and (attempt > 0 or maybe_posted)
+        and is_chunk_posted(flow_id, segment_chunk)
+    ):
+        logger.info(f"Chunk for flow {flow_id} was posted by an earlier attempt")
+        return
     if post.status_code != 201:
         logger.error(
             "Some segments failed to be posted",
             extra={
                 "flow_id": flow_id,
-                "request_body": segment_chunk,
+                "request_body": data,
                 "response_body": post.json(),
             },
         )
     post.raise_for_status()
 
 
-@tracer.capture_method(capture_response=False)
-def post_segments(flow_id: str, segments: list) -> None:
+class SegmentPoster:
     """
-    Post segments to a flow, handling chunking for large payloads.
+    Stream new segments into size-bounded chunks per flow and post them with a bounded worker pool.
 
-    Breaks large segment lists into smaller chunks to avoid API Gateway payload limits.
+    Each segment is serialised once, when it is added. Adding blocks while twice as many chunks
+    as workers are waiting to be posted, so the chunks held are bounded by the chunk size and
+    worker count. Use as a context manager; leaving it posts the remaining chunks and raises
+    the first failure.
 
-    Args:
-        flow_id: The unique identifier of the flow
-        segments: A list of segment dictionaries to post
+    Chunks are keyed by flow and position, which are the same on every run over the same edit
+    items. Chunks whose keys are in posted_chunks are skipped, and on_posted is called from a
+    worker thread with the key of each chunk once it has been posted. When resumed, any other
+    chunk may also have been posted by an earlier run without being recorded.
+
+    before_first_post is called once, before the first chunk is posted or, when there are no
+    chunks to post, on leaving without an error. Nothing is created when fetching fails first.
     """
-    max_payload_size = 6 * 1024 * 1024  # API Gateway payload limit (6MB to be safe)
-    all_segments_json = json.dumps(segments)
-    if len(all_segments_json) <= max_payload_size:
-        post_segment_chunk(flow_id, segments)
-        return
-    chunk = []
-    chunk_size = 0
-    for segment in segments:
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_payload_size: int = MAX_PAYLOAD_SIZE,
+        posted_chunks: set[str] | None = None,
+        on_posted: Callable[[str], None] | None = None,
+        resumed: bool = False,
+        before_first_post: Callable[[], None] | None = None,
+    ) -> None:
+        self._max_payload_size = max_payload_size
+        self._posted_chunks = posted_chunks or set()
+        self._on_posted = on_posted
+        self._resumed = resumed
+        self._before_first_post = before_first_post
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers * 2)
+        self._chunks = defaultdict(list)
+        self._chunk_sizes = Counter()
+        self._chunk_counts = Counter()
+        self._futures = []
+
+    def __enter__(self) -> "SegmentPoster":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                for flow_id in list(self._chunks):
+                    self._submit(flow_id)
+                self._start_posting()
+                for future in self._futures:
+                    future.result()
+        finally:
+            # Every chunk has been waited for unless something failed, so only queued chunks are dropped
+            self._executor.shutdown(cancel_futures=True)
+
+    def add(self, flow_id: str, segment: dict[str, Any]) -> None:
+        """
+        Add a segment to the current chunk of its flow, posting the chunk first if it is full.
+
+        Args:
+            flow_id: The unique identifier of the flow
+            segment: The segment dictionary to post
+        """
         segment_json = json.dumps(segment)
+        # +2 for [] brackets and +1 for each comma
         if (
-            chunk_size + len(segment_json) + 2 > max_payload_size and chunk
-        ):  # +2 for [] brackets
-            logger.info(f"Posting chunk of {len(chunk)} segments for flow {flow_id}")
-            post_segment_chunk(flow_id, chunk)
-            chunk = []
-            chunk_size = 0
-        chunk.append(segment)
-        chunk_size += len(segment_json) + 1  # +1 for comma
-    if chunk:
-        logger.info(f"Posting final chunk of {len(chunk)} segments for flow {flow_id}")
-        post_segment_chunk(flow_id, chunk)
+            self._chunks[flow_id]
+            and self._chunk_sizes[flow_id] + len(segment_json) + 2
+            > self._max_payload_size
+        ):
+            self._submit(flow_id)
+        self._chunks[flow_id].append(segment_json)
+        self._chunk_sizes[flow_id] += len(segment_json) + 1
+
+    def _submit(self, flow_id: str) -> None:
+        segment_chunk = self._chunks.pop(flow_id)
+        del self._chunk_sizes[flow_id]
+        chunk_key = f"{flow_id}/{self._chunk_counts[flow_id]}"
+        self._chunk_counts[flow_id] += 1
+        if chunk_key in self._posted_chunks:
+            logger.info(f"Skipping chunk {chunk_key} posted by a previous run")
+            return
+        self._start_posting()
+        self._slots.acquire()
+        # Stop feeding the pool as soon as a chunk has failed. Each future is checked once, so
+        # one finishing during the pass stays pending and is checked later rather than dropped
+        pending = []
+        for future in self._futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception():
+                self._slots.release()
+                raise future.exception()
+        self._futures = pending
+        future = self._executor.submit(
+            self._post_chunk, chunk_key, flow_id, segment_chunk
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _start_posting(self) -> None:
+        if self._before_first_post:
+            before_first_post, self._before_first_post = self._before_first_post, None
+            before_first_post()
+
+    def _post_chunk(
+        self, chunk_key: str, flow_id: str, segment_chunk: list[str]
+    ) -> None:
+        post_segment_chunk(flow_id, segment_chunk, maybe_posted=self._resumed)
+        if self._on_posted:
+            self._on_posted(chunk_key)
 
 
 @tracer.capture_method(capture_response=False)
@@ -284,39 +598,23 @@ def build_new_segment(
 
 
 @tracer.capture_method(capture_response=False)
-def get_new_flows_and_segments(
+def get_new_flows(
     edit_payload: dict[str, Any],
-) -> tuple[dict[str, dict[str, Any]], dict[str, list[dict[str, Any]]]]:
+) -> tuple[dict[str, dict[str, Any]], dict[str, list[str]]]:
     """
-    Generate new flows and segments based on an edit payload.
-
-    Creates new flows and segments by referencing existing flows and applying
-    the edit operations specified in the payload.
+    Generate new flows based on an edit payload.
 
     Args:
         edit_payload: The edit payload containing edit operations
 
     Returns:
-        A tuple containing (flows_dict, segments_dict) where:
+        A tuple containing (flows_dict, timeranges_dict) where:
         - flows_dict: Dictionary mapping original flow IDs to new flow data
-        - segments_dict: Dictionary mapping new flow IDs to lists of segment data
+        - timeranges_dict: Dictionary mapping original flow IDs to their edit timeranges in EDL order
     """
     flows = {}
-    flow_segments = defaultdict(list)
     format_source_ids = {}
 
-    # Set start of all new segments per flow to be as per edit payload
-    next_start = {
-        flow_id: Timestamp.from_str(
-            edit_payload["configuration"].get("start", DEFAULT_START_TIME)
-        )
-        for flow_id in set(
-            flow_id
-            for edit_item in edit_payload["edit"]
-            for flow_id in edit_item["flows"]
-        )
-    }
-
     for edit_item in edit_payload["edit"]:
         for flow_id in edit_item["flows"]:
             # Initialize flow data if needed
@@ -324,19 +622,75 @@ def get_new_flows_and_segments(
                 flow_id, edit_payload, flows, format_source_ids
             )
 
-            # Skip if flow was not added (e.g., image flows)
-            if flow_id not in flows:
-                continue
+    return flows, get_flow_timeranges(edit_payload["edit"], flows)
 
-            # Process segments for this flow and edit item
-            for segment in get_segments(flow_id, edit_item["timerange"]):
+
+@tracer.capture_method(capture_response=False)
+def get_flow_timeranges(
+    edit_items: list[dict[str, Any]], flows: dict[str, dict[str, Any]]
+) -> dict[str, list[str]]:
+    """
+    Group the timeranges of edit items by the flows they reference.
+
+    Args:
+        edit_items: The edit items to group
+        flows: Dictionary mapping original flow IDs to new flow data
+
+    Returns:
+        Dictionary mapping original flow IDs to their edit timeranges in EDL order, skipping
+        flows that were not added (e.g., image flows)
+    """
+    flow_timeranges = defaultdict(list)
+    for edit_item in edit_items:
+        for flow_id in edit_item["flows"]:
+            if flow_id in flows:
+                flow_timeranges[flow_id].append(edit_item["timerange"])
+    return dict(flow_timeranges)
+
+
+@tracer.capture_method(capture_response=False)
+def get_new_segments(
+    edit_payload: dict[str, Any],
+    flows: dict[str, dict[str, Any]],
+    flow_timeranges: dict[str, list[str]],
+    flow_starts: dict[str, str] | None = None,
+) -> Generator[tuple[str, dict[str, Any]], None, None]:
+    """
+    Generate new segments by referencing the segments of existing flows.
+
+    Segments are fetched once per flow over the union of its edit timeranges and each edit
+    item is answered from an index of those segments. Flows are processed as soon as their
+    segments have been fetched.
+
+    Args:
+        edit_payload: The edit payload containing edit operations
+        flows: Dictionary mapping original flow IDs to new flow data
+        flow_timeranges: Dictionary mapping original flow IDs to their edit timeranges in EDL order
+        flow_starts: Optional dictionary mapping original flow IDs to the start of their first
+            new segment, in place of the start in the edit payload
+
+    Yields:
+        Tuples of (new_flow_id, segment)
+    """
+    # Set start of all new segments per flow to be as per edit payload
+    start = Timestamp.from_str(
+        edit_payload["configuration"].get("start", DEFAULT_START_TIME)
+    )
+
+    for flow_id, segment_index in get_flow_segment_indexes(flow_timeranges):
+        # Each new timerange starts where the previous one for the same flow ended
+        next_start = start
+        if flow_starts and flow_id in flow_starts:
+            next_start = Timestamp.from_str(flow_starts[flow_id])
+        for edit_timerange in flow_timeranges[flow_id]:
+            for segment in lookup_segments(segment_index, edit_timerange):
                 # Calculate timeranges
                 intersection_timerange, new_timerange = calculate_segment_timeranges(
-                    segment, edit_item["timerange"], next_start[flow_id]
+                    segment, edit_timerange, next_start
                 )
 
                 # Update next start time
-                next_start[flow_id] = new_timerange.end
+                next_start = new_timerange.end
 
                 # Calculate offsets
                 old_ts_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
@@ -344,11 +698,11 @@ def get_new_flows_and_segments(
                     old_ts_offset + new_timerange.start - intersection_timerange.start
                 )
 
-                # Create and store the new segment
-                new_segment = build_new_segment(segment, new_timerange, new_ts_offset)
-                flow_segments[flows[flow_id]["id"]].append(new_segment)
-
-    return flows, dict(flow_segments)
+                # Create the new segment
+                yield (
+                    flows[flow_id]["id"],
+                    build_new_segment(segment, new_timerange, new_ts_offset),
+                )
 
 
 @tracer.capture_method(capture_response=False)
@@ -385,27 +739,320 @@ def create_multi_flow(
     }
 
 
-@logger.inject_lambda_context(
-    log_event=True, correlation_id_path=correlation_paths.EVENT_BRIDGE
-)
-@tracer.capture_lambda_handler(capture_response=False)
-# pylint: disable=unused-argument
-def lambda_handler(event: EventBridgeEvent, context: LambdaContext) -> None:
-    edit_payload = event["detail"]
-    new_flows, new_segments = get_new_flows_and_segments(edit_payload)
-
-    # Create multi-flow if needed
-    multi_flow = create_multi_flow(new_flows, edit_payload)
+@tracer.capture_method(capture_response=False)
+def create_flows(
+    flows: dict[str, dict[str, Any]], multi_flow: dict[str, Any] | None
+) -> None:
+    """
+    Create the new flows, and the multi-flow collecting them if there is one.
 
+    Args:
+        flows: Dictionary of new flows
+        multi_flow: The multi-flow dictionary or None
+    """
     # Create new flows
-    for flow in new_flows.values():
+    for flow in flows.values():
         put_flow(flow)
 
     # Create new Multi flow
     if multi_flow:
         put_flow(multi_flow)
 
-    # Create new Segments
-    for flow_id, segments in new_segments.items():
-        if segments:
-            post_segments(flow_id, segments)
+
+@tracer.capture_method(capture_response=False)
+def get_checkpoint_object(key: str) -> Any:
+    """
+    Read a JSON object from the checkpoint bucket.
+
+    Args:
+        key: The key of the object
+
+    Returns:
+        The parsed object, or None if it does not exist
+    """
+    try:
+        get_object = s3.get_object(Bucket=checkpoint_bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise ex
+    return json.loads(get_object["Body"].read())
+
+
+@tracer.capture_method(capture_response=False)
+def put_checkpoint_object(key: str, value: Any) -> None:
+    """
+    Write a JSON object to the checkpoint bucket.
+
+    Args:
+        key: The key of the object
+        value: The value to serialise
+    """
+    s3.put_object(
+        Bucket=checkpoint_bucket,
+        Key=key,
+        Body=json.dumps(value),
+        ContentType="application/json",
+    )
+
+
+@tracer.capture_method(capture_response=False)
+def plan_shards(edit_payload: dict[str, Any]) -> list[dict[str, int]]:
+    """
+    Split the edit items into shards of EDIT_SHARD_SIZE items.
+
+    Args:
+        edit_payload: The edit payload containing edit operations
+
+    Returns:
+        A list of shards with the first and last (exclusive) edit item index
+    """
+    edit_count = len(edit_payload["edit"])
+    return [
+        {"first": first, "last": min(first + edit_shard_size, edit_count)}
+        for first in range(0, edit_count, edit_shard_size)
+    ]
+
+
+@tracer.capture_method(capture_response=False)
+def start_partitioned_edit(job_id: str, edit_payload: dict[str, Any]) -> None:
+    """
+    Hand a large edit payload over to the partitioned state machine.
+
+    Args:
+        job_id: The unique identifier of the edit, used as the execution name
+        edit_payload: The edit payload containing edit operations
+    """
+    put_checkpoint_object(f"{job_id}/edit.json", edit_payload)
+    logger.info(
+        f"Starting partitioned edit of {len(edit_payload['edit'])} items",
+        extra={"job_id": job_id},
+    )
+    sfn.start_execution(
+        stateMachineArn=state_machine_arn,
+        name=job_id,
+        input=json.dumps({"job_id": job_id}),
+    )
+
+
+@tracer.capture_method(capture_response=False)
+def plan_action(event: dict[str, Any]) -> dict[str, Any]:
+    """
+    Choose the new flows of a partitioned edit and split its edit items into shards.
+
+    No segments are read and no flows are created here. The plan, including the new flow IDs,
+    is checkpointed so that a rerun uses the same flows and shards.
+
+    Args:
+        event: The state machine input containing the job_id
+
+    Returns:
+        The job_id with one state machine input per shard
+    """
+    job_id = event["job_id"]
+    plan = get_checkpoint_object(f"{job_id}/plan.json")
+    if plan is None:
+        edit_payload = get_checkpoint_object(f"{job_id}/edit.json")
+        flows, _ = get_new_flows(edit_payload)
+        plan = {
+            "flows": flows,
+            "multi_flow": create_multi_flow(flows, edit_payload),
+            "shards": plan_shards(edit_payload),
+        }
+        put_checkpoint_object(f"{job_id}/plan.json", plan)
+    return {
+        "job_id": job_id,
+        "shards": [
+            {"job_id": job_id, "shard": shard} for shard in range(len(plan["shards"]))
+        ],
+    }
+
+
+@tracer.capture_method(capture_response=False)
+def get_shard_segments(
+    plan: dict[str, Any],
+    edit_payload: dict[str, Any],
+    shard: int,
+    flow_starts: dict[str, str],
+) -> Generator[tuple[str, dict[str, Any]], None, None]:
+    """
+    Generate the new segments of one shard of a partitioned edit.
+
+    Args:
+        plan: The checkpointed plan of the edit
+        edit_payload: The edit payload containing edit operations
+        shard: The index of the shard
+        flow_starts: Dictionary mapping original flow IDs to the start of their first new segment
+
+    Yields:
+        Tuples of (new_flow_id, segment)
+    """
+    boundaries = plan["shards"][shard]
+    yield from get_new_segments(
+        edit_payload,
+        plan["flows"],
+        get_flow_timeranges(
+            edit_payload["edit"][boundaries["first"] : boundaries["last"]],
+            plan["flows"],
+        ),
+        flow_starts,
+    )
+
+
+@tracer.capture_method(capture_response=False)
+def measure_action(event: dict[str, Any]) -> None:
+    """
+    Measure how far one shard of a partitioned edit advances each new flow.
+
+    The shard's segments are generated from zero without being posted, as how far a flow
+    advances depends on the segments found, not only on the edit timeranges. The lengths are
+    checkpointed, so a rerun of a measured shard reads no segments.
+
+    Args:
+        event: The state machine input containing the job_id and shard index
+    """
+    job_id = event["job_id"]
+    lengths_key = f"{job_id}/lengths/{event['shard']}.json"
+    if get_checkpoint_object(lengths_key) is not None:
+        return
+    plan = get_checkpoint_object(f"{job_id}/plan.json")
+    edit_payload = get_checkpoint_object(f"{job_id}/edit.json")
+    new_flow_ids = {flow["id"]: flow_id for flow_id, flow in plan["flows"].items()}
+    zero = str(Timestamp())
+    lengths = {}
+    for new_flow_id, segment in get_shard_segments(
+        plan,
+        edit_payload,
+        event["shard"],
+        {flow_id: zero for flow_id in plan["flows"]},
+    ):
+        lengths[new_flow_ids[new_flow_id]] = str(
+            TimeRange.from_str(segment["timerange"]).end
+        )
+    put_checkpoint_object(lengths_key, lengths)
+
+
+@tracer.capture_method(capture_response=False)
+def flows_action(event: dict[str, Any]) -> None:
+    """
+    Work out where each shard of a partitioned edit starts its flows, then create the flows.
+
+    Each shard starts a flow where the shards before it, by their measured lengths, end it. The
+    flows are only created once every shard has been measured, so an edit that cannot be read
+    creates nothing.
+
+    Args:
+        event: The state machine input containing the job_id
+    """
+    job_id = event["job_id"]
+    plan = get_checkpoint_object(f"{job_id}/plan.json")
+    edit_payload = get_checkpoint_object(f"{job_id}/edit.json")
+    next_starts = dict.fromkeys(
+        plan["flows"],
+        Timestamp.from_str(
+            edit_payload["configuration"].get("start", DEFAULT_START_TIME)
+        ),
+    )
+    shard_starts = []
+    for shard in range(len(plan["shards"])):
+        shard_starts.append(
+            {flow_id: str(start) for flow_id, start in next_starts.items()}
+        )
+        lengths = get_checkpoint_object(f"{job_id}/lengths/{shard}.json")
+        for flow_id, length in lengths.items():
+            next_starts[flow_id] += Timestamp.from_str(length)
+    put_checkpoint_object(f"{job_id}/starts.json", shard_starts)
+    create_flows(plan["flows"], plan["multi_flow"])
+
+
+@tracer.capture_method(capture_response=False)
+def shard_action(event: dict[str, Any]) -> None:
+    """
+    Post the new segments of one shard of a partitioned edit.
+
+    Shards run in parallel, each starting its flows where flows_action worked out. The keys of
+    posted chunks are checkpointed as they complete and skipped by a rerun, and the shard is
+    marked done once complete, so a rerun of a finished shard reads no segments.
+
+    Args:
+        event: The state machine input containing the job_id and shard index
+    """
+    job_id = event["job_id"]
+    checkpoint_key = f"{job_id}/shards/{event['shard']}.json"
+    checkpoint = get_checkpoint_object(checkpoint_key)
+    if checkpoint and checkpoint.get("done"):
+        return
+    # Recorded before posting, as an earlier run may have posted chunks it did not record
+    resumed = checkpoint is not None
+    if not resumed:
+        checkpoint = {"posted": []}
+        put_checkpoint_object(checkpoint_key, checkpoint)
+    plan = get_checkpoint_object(f"{job_id}/plan.json")
+    edit_payload = get_checkpoint_object(f"{job_id}/edit.json")
+    flow_starts = get_checkpoint_object(f"{job_id}/starts.json")[event["shard"]]
+    shard = plan["shards"][event["shard"]]
+    posted_chunks = set(checkpoint["posted"])
+    checkpoint_lock = threading.Lock()
+
+    def on_posted(chunk_key: str) -> None:
+        with checkpoint_lock:
+            posted_chunks.add(chunk_key)
+            put_checkpoint_object(checkpoint_key, {"posted": sorted(posted_chunks)})
+
+    logger.info(
+        f"Processing edit items {shard['first']} to {shard['last']}",
+        extra={"job_id": job_id, "posted_chunks": len(posted_chunks)},
+    )
+    with SegmentPoster(
+        segment_post_workers,
+        posted_chunks=set(posted_chunks),
+        on_posted=on_posted,
+        resumed=resumed,
+    ) as poster:
+        for flow_id, segment in get_shard_segments(
+            plan, edit_payload, event["shard"], flow_starts
+        ):
+            poster.add(flow_id, segment)
+    put_checkpoint_object(
+        checkpoint_key, {"posted": sorted(posted_chunks), "done": True}
+    )
+
+
+@logger.inject_lambda_context(
+    log_event=True, correlation_id_path=correlation_paths.EVENT_BRIDGE
+)
+@tracer.capture_lambda_handler(capture_response=False)
+# pylint: disable=unused-argument
+def lambda_handler(event: EventBridgeEvent, context: LambdaContext) -> dict | None:
+    if "action" in event:
+        match event["action"]:
+            case "PLAN":
+                return plan_action(event)
+            case "MEASURE":
+                return measure_action(event)
+            case "FLOWS":
+                return flows_action(event)
+            case "SHARD":
+                return shard_action(event)
+
+    edit_payload = event["detail"]
+    if edit_shard_size and len(edit_payload["edit"]) > edit_shard_size:
+        start_partitioned_edit(event["id"], edit_payload)
+        return None
+
+    new_flows, flow_timeranges = get_new_flows(edit_payload)
+
+    # Create new Segments, posting chunks while later segments are still being fetched. The new
+    # flows, and a multi-flow if needed, are created just before the first chunk is posted
+    multi_flow = create_multi_flow(new_flows, edit_payload)
+    with SegmentPoster(
+        segment_post_workers,
+        before_first_post=lambda: create_flows(new_flows, multi_flow),
+    ) as poster:
+        for flow_id, segment in get_new_segments(
+            edit_payload, new_flows, flow_timeranges
+        ):
+            poster.add(flow_id, segment)
+    return None
@@ -0,0 +1,66 @@
+"""Fixtures for the tests of the Lambda functions in backend. Each function is imported as Lambda
+imports it, with the openid-auth layer on the path and the TAMS credentials it creates on import
+replaced. Run from backend with the function and layer dependencies installed:
+
+    python -m pytest tests
+"""
+
+import importlib.util
+import os
+from unittest import mock
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIR = os.path.join(BACKEND_DIR, "layers", "openid-auth")
+TAMS_ENDPOINT = "https://tams.example.com"
+CREDENTIALS_ARN = "arn:aws:secretsmanager:eu-west-1:123456789012:secret:tams"
+
+
+def load_function(function_dir, environment):
+    """Imports the app module of the function in a directory of backend with the given environment"""
+    name = os.path.basename(function_dir)
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), os.path.join(BACKEND_DIR, function_dir, "app.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for variable, value in {
+            "AWS_DEFAULT_REGION": "eu-west-1",
+            "POWERTOOLS_TRACE_DISABLED": "1",
+            "POWERTOOLS_LOG_LEVEL": "ERROR",
+            "POWERTOOLS_SERVICE_NAME": name,
+            "POWERTOOLS_METRICS_NAMESPACE": "Test",
+            **environment,
+        }.items():
+            monkeypatch.setenv(variable, value)
+        monkeypatch.syspath_prepend(LAYER_DIR)
+        with mock.patch("openid_auth.Credentials"):
+            spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def edit_by_reference():
+    return load_function(
+        "functions/edit-by-reference",
+        {"TAMS_ENDPOINT": TAMS_ENDPOINT, "SECRET_ARN": CREDENTIALS_ARN},
+    )
+
+
+@pytest.fixture(scope="session")
+def segment_ingestion():
+    return load_function(
+        "components/ingest/functions/sqs-segment-ingestion",
+        {"TAMS_ENDPOINT": TAMS_ENDPOINT, "SECRET_ARN": CREDENTIALS_ARN},
+    )
+
+
+@pytest.fixture(scope="session")
+def lambda_context():
+    return mock.Mock(
+        function_name="test",
+        memory_limit_in_mb=128,
+        invoked_function_arn="arn:aws:lambda:eu-west-1:123456789012:function:test",
+        aws_request_id="test",
+    )
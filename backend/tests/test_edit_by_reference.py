@@ -0,0 +1,325 @@
+"""Edit by reference: the segment index, single edits and partitioned edits"""
+
+import copy
+import json
+import threading
+import unittest
+from collections import defaultdict
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+from mediatimestamp.immutable import TimeRange
+
+# Edit items over both flows, three of them reaching into the gap in the video
+EDIT = {
+    "configuration": {"label": "Edit", "start": "100:0"},
+    "edit": [
+        {"timerange": f"[{start}:500000000_{start + length}:0)", "flows": flows}
+        for start, length, flows in [
+            (3, 10, ["video", "audio"]),
+            (38, 12, ["video", "audio"]),
+            (150, 4, ["audio"]),
+            (11, 1, ["video"]),
+            (0, 30, ["video", "audio"]),
+            (44, 2, ["video", "audio"]),
+            (90, 20, ["video", "audio"]),
+            (7, 7, ["video"]),
+            (120, 40, ["video", "audio"]),
+            (41, 60, ["video", "audio"]),
+            (2, 2, ["audio"]),
+            (180, 19, ["video", "audio"]),
+        ]
+    ],
+}
+
+
+class FakeTams:
+    """The TAMS calls made by the function, over 2 second segments of a video and an audio
+    flow, with segments 20 to 22 of the video missing"""
+
+    def __init__(self):
+        self.flows = {
+            "video": {
+                "id": "video",
+                "source_id": "video-source",
+                "format": "urn:x-nmos:format:video",
+                "essence_parameters": {"frame_rate": {"numerator": 25}},
+            },
+            "audio": {
+                "id": "audio",
+                "source_id": "audio-source",
+                "format": "urn:x-nmos:format:audio",
+                "essence_parameters": {"sample_rate": 48000},
+            },
+        }
+        self.segments = {
+            flow_id: [
+                {
+                    "object_id": f"{flow_id}-{n}",
+                    "timerange": f"[{n * 2}:0_{n * 2 + 2}:0)",
+                    **({"ts_offset": "5:0"} if n % 7 == 0 else {}),
+                }
+                for n in range(100)
+                if flow_id == "audio" or not 20 <= n < 23
+            ]
+            for flow_id in self.flows
+        }
+        self.created = []
+        self.posted = defaultdict(list)
+        self.segment_reads = 0
+        self._lock = threading.Lock()
+
+    def patches(self):
+        return {
+            "get_flow": lambda flow_id: copy.deepcopy(self.flows[flow_id]),
+            "get_segments": self.get_segments,
+            "put_flow": lambda flow: self.created.append(flow["id"]),
+            "post_segment_chunk": self.post_segment_chunk,
+        }
+
+    def get_segments(self, flow_id, timerange):
+        with self._lock:
+            self.segment_reads += 1
+        timerange = TimeRange.from_str(timerange)
+        for segment in self.segments[flow_id]:
+            if TimeRange.from_str(segment["timerange"]).overlaps_with_timerange(
+                timerange
+            ):
+                yield segment
+
+    def post_segment_chunk(self, flow_id, segment_chunk, maybe_posted=False):
+        if flow_id not in self.created:
+            raise RuntimeError(f"Flow {flow_id} does not exist")
+        with self._lock:
+            self.posted[flow_id].extend(map(json.loads, segment_chunk))
+
+    def edited(self):
+        """The segments posted to each created flow, in order of creation and start"""
+        return [
+            sorted(
+                self.posted[flow_id],
+                key=lambda segment: TimeRange.from_str(segment["timerange"]).start,
+            )
+            for flow_id in self.created
+        ]
+
+
+class FakeCheckpointBucket:
+    """The S3 calls made on the checkpoint bucket, with missing keys reported as a ClientError"""
+
+    class exceptions:  # pylint: disable=invalid-name
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Key, **_):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": mock.Mock(read=mock.Mock(return_value=self.objects[Key]))}
+
+    def put_object(self, Key, Body, **_):
+        self.objects[Key] = Body
+
+
+class TestSegmentIndex(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _app(self, edit_by_reference):
+        self.app = edit_by_reference
+
+    def segment(self, start, end):
+        return {"object_id": f"{start}", "timerange": f"[{start}:0_{end}:0)"}
+
+    def test_segment_returned_for_two_timeranges_is_indexed_once(self):
+        index = self.app.build_segment_index(
+            [
+                [self.segment(0, 2), self.segment(2, 4)],
+                [self.segment(2, 4), self.segment(4, 6)],
+            ]
+        )
+
+        self.assertEqual(
+            [segment["object_id"] for _, segment in index[1]], ["0", "2", "4"]
+        )
+
+    def test_lookup_returns_overlapping_segments_in_order(self):
+        index = self.app.build_segment_index(
+            [[self.segment(8, 10), self.segment(2, 4)], [self.segment(0, 2)]]
+        )
+
+        self.assertEqual(
+            self.app.lookup_segments(index, "[3:0_9:0)"),
+            [self.segment(2, 4), self.segment(8, 10)],
+        )
+        self.assertEqual(self.app.lookup_segments(index, "[5:0_7:0)"), [])
+        self.assertEqual(
+            self.app.lookup_segments(index, "[2:0_"),
+            [self.segment(2, 4), self.segment(8, 10)],
+        )
+
+
+class TestSingleEdit(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _tams(self, edit_by_reference, lambda_context):
+        self.app = edit_by_reference
+        self.context = lambda_context
+        self.tams = FakeTams()
+        with (
+            mock.patch.multiple(edit_by_reference, **self.tams.patches()),
+            mock.patch.object(edit_by_reference, "edit_shard_size", 0),
+        ):
+            yield
+
+    def test_new_segments_follow_on_from_the_configured_start(self):
+        self.app.lambda_handler({"detail": EDIT, "id": "edit"}, self.context)
+
+        video = self.tams.edited()[0]
+        self.assertEqual(
+            video[0],
+            {
+                "object_id": "video-1",
+                "timerange": "[100:0_100:500000000)",
+                "ts_offset": "96:500000000",
+            },
+        )
+        for previous, segment in zip(video, video[1:]):
+            self.assertEqual(
+                TimeRange.from_str(segment["timerange"]).start,
+                TimeRange.from_str(previous["timerange"]).end,
+            )
+
+    def test_creates_each_flow_and_a_multi_flow_once(self):
+        self.app.lambda_handler({"detail": EDIT, "id": "edit"}, self.context)
+
+        self.assertEqual(len(self.tams.created), 3)
+        self.assertEqual(len(set(self.tams.created)), 3)
+
+    def test_failed_read_creates_no_flows(self):
+        with mock.patch.object(
+            self.app, "get_segments", side_effect=RuntimeError("read failed")
+        ):
+            with self.assertRaises(RuntimeError):
+                self.app.lambda_handler({"detail": EDIT, "id": "edit"}, self.context)
+
+        self.assertEqual(self.tams.created, [])
+
+
+class TestSegmentPoster(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _app(self, edit_by_reference):
+        self.app = edit_by_reference
+        self.posted = []
+
+    def post(self, flow_id, segment_chunk, maybe_posted=False):
+        if flow_id == "failing":
+            raise RuntimeError("post failed")
+        self.posted.append((flow_id, len(segment_chunk)))
+
+    def test_chunks_are_posted_after_the_flows_are_created(self):
+        before_first_post = mock.Mock(side_effect=lambda: self.posted.append("flows"))
+        with mock.patch.object(self.app, "post_segment_chunk", self.post):
+            with self.app.SegmentPoster(
+                2, max_payload_size=200, before_first_post=before_first_post
+            ) as poster:
+                for n in range(20):
+                    poster.add(
+                        "flow", {"object_id": f"{n}", "timerange": f"[{n}:0_{n + 1}:0)"}
+                    )
+
+        before_first_post.assert_called_once_with()
+        self.assertEqual(self.posted[0], "flows")
+        self.assertEqual(sum(count for _, count in self.posted[1:]), 20)
+
+    def test_nothing_is_created_when_adding_fails_first(self):
+        before_first_post = mock.Mock()
+        with self.assertRaises(RuntimeError):
+            with self.app.SegmentPoster(2, before_first_post=before_first_post):
+                raise RuntimeError("read failed")
+
+        before_first_post.assert_not_called()
+
+    def test_failed_chunk_is_raised(self):
+        with mock.patch.object(self.app, "post_segment_chunk", self.post):
+            with self.assertRaisesRegex(RuntimeError, "post failed"):
+                with self.app.SegmentPoster(2) as poster:
+                    poster.add("failing", {"object_id": "0", "timerange": "[0:0_1:0)"})
+
+
+class TestPartitionedEdit(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _tams(self, edit_by_reference, lambda_context):
+        self.app = edit_by_reference
+        self.context = lambda_context
+        self.tams = FakeTams()
+        self.bucket = FakeCheckpointBucket()
+        with (
+            mock.patch.multiple(edit_by_reference, **self.tams.patches()),
+            mock.patch.multiple(
+                edit_by_reference,
+                s3=self.bucket,
+                sfn=mock.Mock(),
+                edit_shard_size=5,
+                checkpoint_bucket="checkpoints",
+            ),
+        ):
+            yield
+
+    def invoke(self, event):
+        return self.app.lambda_handler(event, self.context)
+
+    def plan(self, job_id):
+        self.invoke({"detail": EDIT, "id": job_id})
+        return self.invoke({"action": "PLAN", "job_id": job_id})["shards"]
+
+    def execute(self, job_id):
+        """Runs the states of the partitioned edit state machine"""
+        shards = self.plan(job_id)
+        for shard in shards:
+            self.invoke({"action": "MEASURE", **shard})
+        self.invoke({"action": "FLOWS", "job_id": job_id})
+        for shard in shards:
+            self.invoke({"action": "SHARD", **shard})
+        return shards
+
+    def test_missing_checkpoint_is_none(self):
+        self.assertIsNone(self.app.get_checkpoint_object("edit/plan.json"))
+
+    def test_edit_is_split_into_shards(self):
+        self.assertEqual(len(self.plan("edit")), 3)
+        self.app.sfn.start_execution.assert_called_once()
+
+    def test_same_segments_as_single_edit(self):
+        single = FakeTams()
+        with (
+            mock.patch.multiple(self.app, **single.patches()),
+            mock.patch.object(self.app, "edit_shard_size", 0),
+        ):
+            self.invoke({"detail": EDIT, "id": "single"})
+
+        self.execute("edit")
+
+        self.assertEqual(self.tams.edited(), single.edited())
+
+    def test_flows_are_created_once_every_shard_is_measured(self):
+        shards = self.plan("edit")
+        for shard in shards:
+            self.invoke({"action": "MEASURE", **shard})
+        self.assertEqual(self.tams.created, [])
+
+        self.invoke({"action": "FLOWS", "job_id": "edit"})
+        self.assertEqual(len(self.tams.created), 3)
+
+    def test_rerun_reads_and_posts_nothing(self):
+        self.execute("edit")
+        edited = self.tams.edited()
+        self.tams.segment_reads = 0
+
+        shards = self.invoke({"action": "PLAN", "job_id": "edit"})["shards"]
+        for shard in shards:
+            self.invoke({"action": "MEASURE", **shard})
+            self.invoke({"action": "SHARD", **shard})
+
+        self.assertEqual(self.tams.segment_reads, 0)
+        self.assertEqual(self.tams.edited(), edited)
@@ -0,0 +1,272 @@
+"""SQS segment ingestion: storage allocation, segment registration and per-record failures"""
+
+import io
+import json
+import unittest
+from collections import defaultdict
+from unittest import mock
+from urllib.parse import urlparse
+
+import pytest
+import requests
+from botocore.exceptions import ClientError
+from mediatimestamp.immutable import TimeRange
+
+
+def response(status_code, body=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = b"" if body is None else json.dumps(body).encode()
+    return resp
+
+
+class FakeTams:
+    """The TAMS calls made by the function, for a video and an audio flow. Segments with an
+    object id in rejected fail, and are reported as TAMS writes their timerange"""
+
+    def __init__(self):
+        self.formats = {
+            "video": "urn:x-nmos:format:video",
+            "audio": "urn:x-nmos:format:audio",
+        }
+        self.rejected = set()
+        self.storage_requests = []
+        self.segment_posts = []
+        self.registered = defaultdict(list)
+        self.uploads = {}
+        self._object_count = 0
+
+    def patches(self):
+        return {"get": self.get, "post": self.post, "put": self.put}
+
+    def get(self, url, **_):
+        flow_id = urlparse(url).path.split("/")[2]
+        if flow_id not in self.formats:
+            return response(404, {"message": "flow not found"})
+        return response(200, {"id": flow_id, "format": self.formats[flow_id]})
+
+    def post(self, url, data, **_):
+        _, _, flow_id, resource = urlparse(url).path.split("/")
+        if flow_id not in self.formats:
+            return response(404, {"message": "flow not found"})
+        body = json.loads(data)
+        if resource == "storage":
+            self.storage_requests.append((flow_id, body))
+            object_ids = body.get("object_ids") or [
+                f"object-{self._object_count + i}" for i in range(body["limit"])
+            ]
+            self._object_count += len(object_ids)
+            return response(
+                201,
+                {
+                    "media_objects": [
+                        {
+                            "object_id": object_id,
+                            "put_url": {
+                                "url": f"https://store.example.com/{object_id}",
+                                "content-type": "video/mp2t",
+                            },
+                        }
+                        for object_id in object_ids
+                    ]
+                },
+            )
+        self.segment_posts.append((flow_id, body))
+        segments = body if isinstance(body, list) else [body]
+        failed = [
+            segment for segment in segments if segment["object_id"] in self.rejected
+        ]
+        self.registered[flow_id].extend(
+            segment for segment in segments if segment not in failed
+        )
+        if not isinstance(body, list):
+            return (
+                response(400, {"message": "bad segment"}) if failed else response(201)
+            )
+        if failed:
+            return response(
+                200,
+                {
+                    "failed_segments": [
+                        {
+                            "object_id": segment["object_id"],
+                            "timerange": str(TimeRange.from_str(segment["timerange"])),
+                            "error": {"summary": "bad segment"},
+                        }
+                        for segment in failed
+                    ]
+                },
+            )
+        return response(201)
+
+    def put(self, url, data, **_):
+        self.uploads[url] = data.read() if hasattr(data, "read") else data
+        return response(200)
+
+
+class FakeSourceBucket:
+    """The S3 calls made on source files, which exist unless their key starts with missing"""
+
+    class exceptions:  # pylint: disable=invalid-name
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self):
+        self.deleted = []
+
+    def head_object(self, Key, **_):
+        if Key.startswith("missing"):
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+
+    def get_object(self, Key, **_):
+        if Key.startswith("missing"):
+            raise self.exceptions.NoSuchKey(
+                {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+            )
+        return {"Body": io.BytesIO(Key.encode()), "ContentLength": len(Key)}
+
+    def delete_object(self, Key, **_):
+        self.deleted.append(Key)
+
+
+def record(message_id, message):
+    return {
+        "messageId": message_id,
+        "receiptHandle": "handle",
+        "body": json.dumps(message),
+        "attributes": {
+            "ApproximateReceiveCount": "1",
+            "SentTimestamp": "1700000000000",
+            "SenderId": "sender",
+            "ApproximateFirstReceiveTimestamp": "1700000001000",
+        },
+        "messageAttributes": {},
+        "md5OfBody": "",
+        "eventSource": "aws:sqs",
+        "eventSourceARN": "arn:aws:sqs:eu-west-1:123456789012:ingest",
+        "awsRegion": "eu-west-1",
+    }
+
+
+def segment_message(flow_id, n, **fields):
+    return {
+        "flowId": flow_id,
+        "uri": f"s3://sources/{flow_id}/{n}.ts",
+        "timerange": f"[{n * 2}:0_{n * 2 + 2}:0)",
+        **fields,
+    }
+
+
+class TestIngestion(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _app(self, segment_ingestion, lambda_context, monkeypatch):
+        # single_metric reads the namespace when a record is handled
+        monkeypatch.setenv("POWERTOOLS_METRICS_NAMESPACE", "Test")
+        self.app = segment_ingestion
+        self.context = lambda_context
+
+    def ingest(self, messages, record_workers=1, rejected=()):
+        """Handles a batch of messages, returning the IDs of the messages that failed"""
+        self.tams = FakeTams()
+        self.tams.rejected.update(rejected)
+        self.bucket = FakeSourceBucket()
+        with (
+            mock.patch.multiple(self.app.requests, **self.tams.patches()),
+            mock.patch.multiple(
+                self.app, s3=self.bucket, record_workers=record_workers
+            ),
+        ):
+            result = self.app.lambda_handler(
+                {
+                    "Records": [
+                        record(f"message-{i}", message)
+                        for i, message in enumerate(messages)
+                    ]
+                },
+                self.context,
+            )
+        return [failure["itemIdentifier"] for failure in result["batchItemFailures"]]
+
+    def test_storage_and_segments_requested_once_per_flow(self):
+        messages = [segment_message("video", n) for n in range(3)] + [
+            segment_message("audio", 0, object_id="audio-0"),
+            segment_message("audio", 1, object_id="audio-1"),
+        ]
+        for record_workers in (1, 4):
+            with self.subTest(record_workers=record_workers):
+                self.assertEqual(self.ingest(messages, record_workers), [])
+                self.assertEqual(
+                    sorted(self.tams.storage_requests),
+                    [
+                        ("audio", {"object_ids": ["audio-0", "audio-1"]}),
+                        ("video", {"limit": 3}),
+                    ],
+                )
+                self.assertEqual(
+                    sorted(flow_id for flow_id, _ in self.tams.segment_posts),
+                    ["audio", "video"],
+                )
+                self.assertEqual(len(self.tams.uploads), 5)
+
+    def test_failed_segments_are_matched_on_object_id(self):
+        messages = [
+            segment_message("video", 0, object_id="video-0"),
+            segment_message(
+                "video",
+                1,
+                object_id="video-1",
+                timerange="[2:000000000_4:000000000)",
+            ),
+            segment_message("video", 2, object_id="video-2"),
+        ]
+
+        self.assertEqual(self.ingest(messages, rejected={"video-1"}), ["message-1"])
+        self.assertEqual(
+            [segment["object_id"] for segment in self.tams.registered["video"]],
+            ["video-0", "video-2"],
+        )
+
+    def test_rejected_request_is_retried_per_segment(self):
+        messages = [
+            segment_message("video", n, object_id=f"video-{n}") for n in range(3)
+        ]
+        with mock.patch.object(self.app, "post_segments", return_value=None):
+            self.assertEqual(self.ingest(messages, rejected={"video-2"}), ["message-2"])
+
+        self.assertEqual(len(self.tams.segment_posts), 3)
+
+    def test_missing_source_fails_only_its_record(self):
+        messages = [
+            segment_message("video", 0),
+            segment_message("video", 1, uri="s3://sources/missing.ts"),
+            segment_message("video", 2),
+        ]
+        for record_workers in (1, 4):
+            with self.subTest(record_workers=record_workers):
+                self.assertEqual(self.ingest(messages, record_workers), ["message-1"])
+                self.assertEqual(self.tams.storage_requests, [("video", {"limit": 2})])
+                self.assertEqual(len(self.tams.registered["video"]), 2)
+
+    def test_unknown_flow_fails_only_its_records(self):
+        messages = [
+            segment_message("video", 0),
+            segment_message("deleted", 0),
+            segment_message("deleted", 1),
+            segment_message("audio", 0),
+        ]
+        for record_workers in (1, 4):
+            with self.subTest(record_workers=record_workers):
+                self.assertEqual(
+                    sorted(self.ingest(messages, record_workers)),
+                    ["message-1", "message-2"],
+                )
+                self.assertEqual(sorted(self.tams.registered), ["audio", "video"])
+
+    def test_source_is_deleted_once_registered(self):
+        messages = [
+            segment_message("video", 0, deleteSource=True),
+            segment_message("video", 1, object_id="video-1", deleteSource=True),
+        ]
+
+        self.assertEqual(self.ingest(messages, rejected={"video-1"}), ["message-1"])
+        self.assertEqual(self.bucket.deleted, ["video/0.ts"])